@@ -1,5 +1,218 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Query
-from typing import List, Optional, Annotated
+from typing import Any, List, Optional, Annotated, AsyncIterator, BinaryIO, Callable, Dict, Iterable, Iterator, Sequence, Tuple
+import asyncio
+import contextlib
+import threading
+import tempfile
+import hashlib
+import os
+import re
+import shutil
+import orjson
+from app.core.config import settings
+from app.services.ifc.cache import ifc_file_cache
+from app.services.ifc.extraction import BatchRounder
+
+def _pick_upload_tmpdir() -> Optional[str]:
+    """Choose where upload temp files go.
+
+    Prefers the tmpfs at /dev/shm, so writing an upload and parsing it never
+    touch the disk, but only when it has room for the largest allowed upload
+    (container defaults are often just 64MB). None means the system temp dir.
+    """
+    if settings.UPLOAD_TMPDIR:
+        return settings.UPLOAD_TMPDIR
+    shm = '/dev/shm'
+    try:
+        if os.access(shm, os.W_OK) and shutil.disk_usage(shm).free >= settings.MAX_UPLOAD_SIZE:
+            return shm
+    except OSError:
+        pass
+    return None
+
+UPLOAD_TMPDIR = _pick_upload_tmpdir()
+
+def make_upload_tempfile(suffix: str = '.ifc') -> str:
+    """Create an empty temp file for an upload in UPLOAD_TMPDIR, returning its path."""
+    fd, temp_path = tempfile.mkstemp(suffix=suffix, dir=UPLOAD_TMPDIR)
+    os.close(fd)
+    return temp_path
+
+# Uploads are copied to disk in 1MB chunks so the whole IFC never sits in memory
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def copy_upload(
+    src: BinaryIO,
+    dst_path: str,
+    max_size: Optional[int] = None,
+    hasher=None,
+    chunk_size: int = UPLOAD_CHUNK_SIZE
+) -> int:
+    """Copy an upload's file object to dst_path in chunks, returning its size.
+
+    Blocking; run it on a worker thread. One thread hop copies the whole upload,
+    where awaiting UploadFile.read() and an async write per chunk took two.
+    Raises a 413 HTTPException as soon as more than max_size bytes are read.
+    """
+    size = 0
+    src.seek(0)
+    # Chunks are read into one reused buffer instead of a new bytes object
+    # each; file objects without readinto (SpooledTemporaryFile before 3.11)
+    # fall back to read()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    readinto = getattr(src, 'readinto', None)
+    with open(dst_path, 'wb') as dst:
+        while True:
+            if readinto is not None:
+                length = readinto(view)
+                chunk = view[:length]
+            else:
+                chunk = src.read(chunk_size)
+                length = len(chunk)
+            if not length:
+                break
+            size += length
+            if max_size is not None and size > max_size:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File too large. Maximum size is {max_size/1024/1024:.1f}MB"
+                )
+            if hasher is not None:
+                hasher.update(chunk)
+            dst.write(chunk)
+    return size
+
+# Every IFC-SPF file starts with the STEP exchange structure header
+_STEP_HEADER = b'ISO-10303-21'
+_HEADER_PEEK_SIZE = 64
+
+def check_ifc_header(src: BinaryIO):
+    """Reject an upload that does not start with the ISO-10303-21 header of an IFC file.
+
+    Only peeks at the first bytes, so files that merely end in .ifc are turned
+    away before they are copied or parsed.
+    """
+    src.seek(0)
+    head = src.read(_HEADER_PEEK_SIZE)
+    src.seek(0)
+    if not head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(_STEP_HEADER):
+        raise HTTPException(status_code=400, detail="Invalid file content. Not an IFC (ISO-10303-21) file.")
+
+def remove_file(path: Optional[str]):
+    """Delete a temp file if it still exists, without a separate exists() check."""
+    if not path:
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+@contextlib.asynccontextmanager
+async def spool_upload(file: UploadFile, max_size: Optional[int] = None) -> AsyncIterator[Tuple[str, str]]:
+    """Stream an upload to a temp file, yielding (temp_path, content_hash).
+
+    Uploads without an IFC header are rejected with a 400 before anything is
+    copied. The copy runs on a worker thread so disk I/O does not block the
+    event loop, and uploads over max_size are rejected with a 413. The temp
+    file is removed exactly once when the context exits, also on a worker
+    thread.
+    """
+    check_ifc_header(file.file)
+    temp_path = await asyncio.to_thread(make_upload_tempfile)
+    try:
+        hasher = hashlib.blake2b(digest_size=16)
+        await asyncio.to_thread(copy_upload, file.file, temp_path, max_size, hasher)
+        yield temp_path, hasher.hexdigest()
+    finally:
+        try:
+            await asyncio.to_thread(remove_file, temp_path)
+        except asyncio.CancelledError:
+            # A cancelled request still must not leave its upload behind
+            remove_file(temp_path)
+            raise
+
+# Uploads up to this size are parsed from memory instead of a temp file
+IN_MEMORY_UPLOAD_SIZE = 16 * 1024 * 1024
+
+def read_small_upload(src: BinaryIO, limit: int, hasher) -> Optional[str]:
+    """Read an upload of at most limit bytes as text, hashing it.
+
+    Blocking; run it on a worker thread. Returns None, without hashing
+    anything, when the upload is larger or is not UTF-8 text (ifcopenshell
+    parses strings as UTF-8); it is then spooled to disk instead.
+    """
+    src.seek(0, os.SEEK_END)
+    size = src.tell()
+    if size > limit:
+        return None
+    src.seek(0)
+    data = src.read()
+    try:
+        content = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    hasher.update(data)
+    return content
+
+@contextlib.asynccontextmanager
+async def buffer_upload(
+    file: UploadFile,
+    max_size: Optional[int] = None,
+    in_memory_size: int = IN_MEMORY_UPLOAD_SIZE
+) -> AsyncIterator[Tuple[Optional[str], Optional[str], str]]:
+    """Like spool_upload, but keeps small uploads in memory, yielding (temp_path, content, content_hash).
+
+    Uploads of up to in_memory_size bytes are yielded as content with no temp
+    file (temp_path is None), so they are never written out and read back.
+    Larger ones are spooled to a temp file and content is None.
+    """
+    check_ifc_header(file.file)
+    hasher = hashlib.blake2b(digest_size=16)
+    limit = in_memory_size if max_size is None else min(in_memory_size, max_size)
+    content = await asyncio.to_thread(read_small_upload, file.file, limit, hasher)
+    if content is not None:
+        yield None, content, hasher.hexdigest()
+        return
+
+    async with spool_upload(file, max_size) as (temp_path, file_hash):
+        yield temp_path, None, file_hash
+
+UNKNOWN_CACHE_KEY = "Unknown cache_key. Upload the IFC file again."
+
+def open_upload(file_hash: str, temp_path: Optional[str]) -> Dict[str, Any]:
+    """Get the parsed model of a request resolved by ifc_upload.
+
+    A cache_key that ifc_upload found can still be evicted before the model
+    is opened, which is reported like any other unknown cache_key.
+    """
+    try:
+        return ifc_file_cache.open(file_hash, temp_path)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=UNKNOWN_CACHE_KEY)
+
+@contextlib.asynccontextmanager
+async def ifc_upload(file: Optional[UploadFile], cache_key: Optional[str]) -> AsyncIterator[Tuple[Optional[str], str]]:
+    """Resolve the IFC file of a request, yielding (temp_path, cache key of the parsed file).
+
+    A known cache_key is served from the parse cache without a temp file
+    (temp_path is None); otherwise the upload is spooled to disk. Open the
+    model with open_upload.
+    """
+    if cache_key and cache_key in ifc_file_cache:
+        yield None, cache_key
+        return
+
+    if file is None:
+        raise HTTPException(
+            status_code=404 if cache_key else 400,
+            detail=UNKNOWN_CACHE_KEY if cache_key else "An IFC file is required."
+        )
+    if not file.filename.endswith('.ifc'):
+        raise HTTPException(status_code=400, detail="Invalid file type. Must be an IFC file.")
+
+    async with spool_upload(file) as upload:
+        yield upload
 
 # Shared utility functions
 def _round_value(value: float, digits: int = 3) -> float:
@@ -8,7 +221,134 @@ def _round_value(value: float, digits: int = 3) -> float:
         return round(value, digits)
     return value
 
+# Same options ORJSONResponse serializes with
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def iter_json_batches(head: Dict, list_key: str, batches: Iterable[List]) -> Iterator[bytes]:
+    """Serialize head as JSON with a list under list_key that is filled from batches.
+
+    The list is written last, one batch at a time as the batches are
+    produced, so a large list is never built or encoded as a whole.
+    """
+    encoded_head = orjson.dumps(head, option=ORJSON_OPTIONS)
+    yield encoded_head[:-1] + (b',' if len(encoded_head) > 2 else b'') + orjson.dumps(list_key) + b':['
+
+    separator = b''
+    for batch in batches:
+        if not batch:
+            continue
+        # One orjson call per batch: the batch's list brackets are dropped so
+        # its items continue the list under list_key
+        yield separator + orjson.dumps(batch, option=ORJSON_OPTIONS)[1:-1]
+        separator = b','
+
+    yield b']}'
+
+# Chunks a stream's producer thread may run ahead of the client by
+STREAM_QUEUE_SIZE = 64
+
+# Marks the end of the chunks handed over by the producer thread
+_STREAM_END = object()
+
+async def iterate_in_thread(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    """Run a blocking chunk generator on a worker thread and yield its chunks.
+
+    Building a stream's chunks is CPU work in Python and ifcopenshell, so it
+    runs off the event loop and hands its chunks over through a bounded
+    asyncio.Queue; the loop stays free to send them and serve other requests
+    meanwhile. If the stream is abandoned (the client went away), the worker
+    stops after the chunk it is on and closes chunks itself, since a
+    generator cannot be closed from another thread while it is running.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def put(item):
+        # Blocks the worker while the queue is full
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    return
+                put(chunk)
+            if not stopped.is_set():
+                put(_STREAM_END)
+        except Exception as e:
+            if not stopped.is_set():
+                put(e)
+        finally:
+            chunks.close()
+
+    worker = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        await worker
+    finally:
+        # Stop the worker if the client went away; emptying the queue releases
+        # a put it may be blocked in
+        stopped.set()
+        while not queue.empty():
+            queue.get_nowait()
+
+def page_window(sequences: Iterable[Sequence], start: int, stop: int) -> Iterator:
+    """Iterate items start to stop of the concatenated sequences.
+
+    Sequences that end before the window are skipped by their length, and
+    none are requested after it, so only the items on the page are touched.
+    """
+    if stop <= start:
+        return
+    for sequence in sequences:
+        length = len(sequence)
+        if start < length:
+            yield from sequence[start:stop]
+            start = 0
+        else:
+            start -= length
+        stop -= length
+        # Do not ask for the sequence after the page
+        if stop <= 0:
+            return
+
+# Element totals per (upload hash, classes) so paging through a file only counts once
+_MAX_CACHED_COUNTS = 256
+_element_counts: Dict[Tuple[str, Tuple[str, ...]], int] = {}
+_element_counts_lock = threading.Lock()
+
+def get_element_page(
+    by_type: Callable[[str], Sequence],
+    file_hash: str,
+    classes: Sequence[str],
+    start_idx: int,
+    end_idx: int
+) -> Tuple[int, Iterator]:
+    """Return the total number of elements of the given classes and an iterator over one page."""
+    key = (file_hash, tuple(classes))
+    with _element_counts_lock:
+        total = _element_counts.get(key)
+
+    if total is None:
+        total = sum(len(by_type(class_name)) for class_name in classes)
+        with _element_counts_lock:
+            _element_counts[key] = total
+            while len(_element_counts) > _MAX_CACHED_COUNTS:
+                del _element_counts[next(iter(_element_counts))]
+
+    return total, page_window((by_type(class_name) for class_name in classes), start_idx, end_idx)
+
 # Shared dependencies
+# Swagger can send class names wrapped as 'List ["IfcWall"]'
+_CLASS_NAME_CLEANUP_RE = re.compile(r'^\s*(?:List\s*\[)?\s*["\']?|["\']?\s*\]?\s*$')
+
 async def get_ifc_classes(
     enable_filter: Annotated[bool, Query(description="Enable filtering by IFC classes")] = False,
     ifc_classes: Optional[List[str]] = Query(
@@ -24,11 +364,11 @@ async def get_ifc_classes(
     if not ifc_classes:
         return None
         
-    # Clean up each class name
+    # Clean up each class name: remove "List [", "]", quotes and spaces in one regex pass
     cleaned_classes = []
     for cls in ifc_classes:
-        # Remove "List [", "]" and clean up quotes and spaces
-        cls = cls.replace("List [", "").replace("]", "").strip().strip('"\'')
+        cls = _CLASS_NAME_CLEANUP_RE.sub('', cls)
         if cls:  # Only add non-empty strings
             cleaned_classes.append(cls)
-    return cleaned_classes if cleaned_classes else None 
\ No newline at end of file
+    # Drop repeated classes, keeping the requested order, so no element is returned twice
+    return list(dict.fromkeys(cleaned_classes)) if cleaned_classes else None 
\ No newline at end of file
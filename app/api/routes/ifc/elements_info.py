@@ -1,17 +1,94 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Query, Depends
+from fastapi.responses import ORJSONResponse
 from typing import Dict, Any, Optional, List
-import tempfile
-import os
 import logging
-import math
+import asyncio
 import ifcopenshell
-from .common import get_ifc_classes
+from app.services.ifc.cache import cached_by_type
+from .common import get_ifc_classes, get_element_page, ifc_upload, open_upload
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
+def _expand_reference(value: Any, depth: int) -> Any:
+    """Expand entity references up to depth levels; deeper references become {"id", "type"} stubs."""
+    if isinstance(value, ifcopenshell.entity_instance):
+        if depth > 0:
+            return _get_info_to_depth(value, depth - 1)
+        return {"id": value.id(), "type": value.is_a()}
+    if isinstance(value, (tuple, list)):
+        return [_expand_reference(item, depth) for item in value]
+    return value
+
+def _get_info_to_depth(entity, depth: int) -> Dict[str, Any]:
+    """Like get_info(recursive=True), but only resolves referenced entities depth levels deep."""
+    info = entity.get_info(include_identifier=True, recursive=False)
+    for key, value in info.items():
+        info[key] = _expand_reference(value, depth)
+    return info
+
+def _process_elements_info(
+    temp_path: Optional[str],
+    file_hash: str,
+    page: int,
+    page_size: int,
+    filtered_classes: Optional[List[str]],
+    max_depth: int = 1
+) -> Dict[str, Any]:
+    """Open the IFC file (or reuse the cached parse) and collect the requested page of element info.
+
+    Runs in a worker thread so parsing does not block the event loop.
+    """
+    model = open_upload(file_hash, temp_path)
+    
+    # Get all elements (using "IfcProduct" as the base class) or filter by class if specified
+    classes = filtered_classes if filtered_classes else ["IfcProduct"]
+
+    # Calculate pagination
+    start_idx = (page - 1) * page_size
+    total_elements, page_elements = get_element_page(
+        lambda class_name: cached_by_type(model, class_name),
+        file_hash, classes, start_idx, start_idx + page_size
+    )
+    total_pages = (total_elements + page_size - 1) // page_size
+    
+    # Get info for paginated elements
+    elements_info = []
+    for element in page_elements:
+        try:
+            if max_depth < 0:
+                # Get the complete element info; get_info_2 is not available
+                # in every ifcopenshell release, get_info returns the same
+                info = element.get_info(include_identifier=True, recursive=True)
+            else:
+                # Only resolve what the caller asked for
+                info = _get_info_to_depth(element, max_depth)
+            
+            # Add element type for easier filtering; get_info already resolved it
+            info['ifc_class'] = info.get('type') or element.is_a()
+            elements_info.append(info)
+            
+        except Exception as e:
+            logger.warning(f"Error getting info for element {element.id()}: {str(e)}")
+            continue
+
+    return {
+        "metadata": {
+            "total_elements": total_elements,
+            "total_pages": total_pages,
+            "current_page": page,
+            "page_size": page_size,
+            "filtered_classes": filtered_classes if filtered_classes else [],
+            "cache_key": file_hash
+        },
+        "elements": elements_info
+    }
+
+
+
 @router.post("/elements-info",
+    response_class=ORJSONResponse,
     summary="Get detailed technical information about IFC elements",
     description="""Get complete technical information about IFC elements following the IFC schema structure.
     Returns detailed data including GlobalIds, ownership history, geometry placements, and relationships.
@@ -29,6 +106,14 @@ logger = logging.getLogger(__name__)
     - Geometric placement information
     - All IFC attributes as defined in the schema
 
+    Referenced entities are expanded `max_depth` levels deep (default: 1); deeper
+    references are returned as `{"id": ..., "type": ...}` stubs. Use `max_depth=-1`
+    for the complete recursive structure, which can be very large.
+
+    **Breaking change:** earlier versions always returned the complete recursive
+    structure. Clients that read nested references beyond the first level must
+    now pass `max_depth=-1` (or a larger depth).
+
     Example response structure:
     ```json
     {
@@ -37,7 +122,8 @@ logger = logging.getLogger(__name__)
         "total_pages": 6,
         "current_page": 1,
         "page_size": 50,
-        "filtered_classes": []
+        "filtered_classes": [],
+        "cache_key": "5b0c2f7e9d1a4c3b8e6f0a2d4c6e8b1f"
       },
       "elements": [
         {
@@ -45,8 +131,8 @@ logger = logging.getLogger(__name__)
           "Name": "Rafter 71 x 171",
           "ObjectType": "Rafter 71 x 171",
           "OwnerHistory": {
-            "OwningUser": { ... },
-            "OwningApplication": { ... },
+            "OwningUser": { "id": 5, "type": "IfcPersonAndOrganization" },
+            "OwningApplication": { "id": 6, "type": "IfcApplication" },
             "CreationDate": 1412774152
           },
           "ObjectPlacement": { ... },
@@ -60,76 +146,23 @@ logger = logging.getLogger(__name__)
     use the /extract-building-elements endpoint instead.""")
     
 async def get_elements_info(
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
     page: Optional[int] = Query(1, ge=1, description="Page number (default: 1)"),
     page_size: Optional[int] = Query(50, ge=1, le=10000, description="Items per page (default: 50)"),
-    filtered_classes: Optional[List[str]] = Depends(get_ifc_classes)
+    filtered_classes: Optional[List[str]] = Depends(get_ifc_classes),
+    cache_key: Optional[str] = Query(None, description="cache_key from a previous response to reuse the already parsed file without uploading it again"),
+    max_depth: int = Query(1, ge=-1, description="Levels of referenced entities to expand (default: 1). 0 returns references as {id, type}; -1 returns the complete recursive structure")
 ) -> Dict[str, Any]:
 
-    if not file.filename.endswith('.ifc'):
-        raise HTTPException(status_code=400, detail="Invalid file type. Must be an IFC file.")
-        
-    # Save uploaded file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.ifc') as temp_file:
-        content = await file.read()
-        temp_file.write(content)
-        temp_path = temp_file.name
-
-    try:
-        ifc_file = ifcopenshell.open(temp_path)
-        
-        # Get all elements or filter by class if specified
-        if filtered_classes:
-            elements = []
-            for class_name in filtered_classes:
-                elements.extend(ifc_file.by_type(class_name))
-        else:
-            # Fix: Get all elements by using "IfcProduct" as the base class
-            elements = ifc_file.by_type("IfcProduct")
-
-        # Calculate pagination
-        total_elements = len(elements)
-        total_pages = math.ceil(total_elements / page_size)
-        start_idx = (page - 1) * page_size
-        end_idx = min(start_idx + page_size, total_elements)
-        
-        # Get info for paginated elements
-        elements_info = []
-        for element in elements[start_idx:end_idx]:
-            try:
-                # Get element info using get_info_2
-                info = element.get_info_2(
-                    include_identifier=True,
-                    recursive=True,  # Must be True for get_info_2
-                    return_type=dict,
-                    ignore=()
-                )
-                
-                # Add element type for easier filtering
-                info['ifc_class'] = element.is_a()
-                elements_info.append(info)
-                
-            except Exception as e:
-                logger.warning(f"Error getting info for element {element.id()}: {str(e)}")
-                continue
-
-        response = {
-            "metadata": {
-                "total_elements": total_elements,
-                "total_pages": total_pages,
-                "current_page": page,
-                "page_size": page_size,
-                "filtered_classes": filtered_classes if filtered_classes else []
-            },
-            "elements": elements_info
-        }
-
-        return response
+    async with ifc_upload(file, cache_key) as (temp_path, file_hash):
+        try:
+            response = await asyncio.to_thread(
+                _process_elements_info, temp_path, file_hash, page, page_size, filtered_classes, max_depth
+            )
+            return ORJSONResponse(response)
 
-    except Exception as e:
-        logger.error(f"Error processing IFC file: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Cleanup
-        if os.path.exists(temp_path):
-            os.unlink(temp_path)
\ No newline at end of file
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error processing IFC file: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
@@ -1,25 +1,29 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Query, Depends, BackgroundTasks, Form
-from typing import List, Optional, Annotated, Dict, Any
-import tempfile
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from typing import List, Optional, Annotated, Dict, Any, Iterator, Tuple
+from concurrent.futures import ProcessPoolExecutor
 import os
 import logging
-import math
-import ifcopenshell
+import contextlib
+import itertools
+import multiprocessing
+import threading
 import httpx
+import orjson
 import asyncio
 import uuid
 from pydantic import BaseModel, HttpUrl, ValidationError
-from app.services.ifc.properties import get_common_properties, get_object_type, get_model_metadata
-from app.services.ifc.quantities import (
-    get_volume_from_properties,
-    get_area_from_properties,
-    get_dimensions_from_properties
+from app.services.ifc.properties import get_model_metadata
+from app.services.ifc.cache import classified_elements, elements_by_class
+from app.services.ifc.extraction import (
+    BatchRounder,
+    ElementExtractor,
+    ExtractOptions,
+    extract_chunk,
+    init_extract_worker
 )
-from app.services.lca.materials import MaterialService
-from app.services.ifc.units import get_project_units, convert_unit_value
-from app.services.ifc.constituents import compute_constituent_fractions
-from .common import _round_value, get_ifc_classes
-import json
+from .common import ORJSON_OPTIONS, get_ifc_classes, ifc_upload, iter_json_batches, iterate_in_thread, open_upload, page_window
 
 def generate_unique_id() -> str:
     """Generate a unique task ID."""
@@ -40,16 +44,77 @@ class CallbackConfigForm(BaseModel):
     ):
         if callback_config:
             try:
-                config_dict = json.loads(callback_config)
+                config_dict = orjson.loads(callback_config)
                 return cls(callback_config=CallbackConfig(**config_dict))
-            except (json.JSONDecodeError, ValidationError):
+            except (orjson.JSONDecodeError, TypeError, ValidationError):
                 return cls(callback_config=None)
         return cls(callback_config=None)
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Pages with at least this many elements are extracted across worker processes
+PARALLEL_MIN_ELEMENTS = 2000
+# Each worker holds its own parse of the upload while it extracts, on top of
+# the models in the parse cache, so only a few are started
+EXTRACT_WORKERS = min(4, os.cpu_count() or 1)
+
+_extract_pool: Optional[ProcessPoolExecutor] = None
+_extract_pool_lock = threading.Lock()
+
+def _get_extract_pool() -> ProcessPoolExecutor:
+    """Get the worker pool, creating it if it was not started with the app."""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            _extract_pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_extract_worker
+            )
+        return _extract_pool
+
+def start_extract_pool():
+    """Create the worker pool and start its processes in the background.
+
+    Spawning a worker and importing the app in it takes a while; doing it at
+    startup keeps that out of the first large request.
+    """
+    pool = _get_extract_pool()
+    for _ in range(EXTRACT_WORKERS):
+        pool.submit(os.getpid)
+
+def shutdown_extract_pool():
+    """Stop the worker processes, if any were started."""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is not None:
+            _extract_pool.shutdown(cancel_futures=True)
+            _extract_pool = None
+
+# Shared by all callback posts so connections to a callback host are pooled
+# instead of set up (including TLS) again for every request
+_callback_client: Optional[httpx.AsyncClient] = None
+
+def get_callback_client() -> httpx.AsyncClient:
+    """Get the shared callback client, creating it on first use."""
+    global _callback_client
+    if _callback_client is None:
+        _callback_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_keepalive_connections=32)
+        )
+    return _callback_client
+
+async def close_callback_client():
+    """Close the shared callback client and its pooled connections."""
+    global _callback_client
+    if _callback_client is not None:
+        await _callback_client.aclose()
+        _callback_client = None
+
 @router.post("/extract-building-elements",
+    response_class=ORJSONResponse,
     summary="Extract Detailed Building Element Data",
     description="""
     Extracts comprehensive information about building elements including properties, 
@@ -57,7 +122,7 @@ logger = logging.getLogger(__name__)
 
     If callback_config is provided:
     - The endpoint returns immediately with a task ID
-    - Progress updates (10%) are sent to the callback URL
+    - Progress updates (every 10% of the requested page) are sent to the callback URL
     - Final results are sent to the callback URL
     - All callback requests include the provided token in Authorization header
 
@@ -78,6 +143,7 @@ logger = logging.getLogger(__name__)
         "current_page": 1,
         "page_size": 50,
         "ifc_classes": [],  // Filtered classes if specified
+        "cache_key": "5b0c2f7e9d1a4c3b8e6f0a2d4c6e8b1f",  // Pass as ?cache_key= to page without re-uploading
         "units": {
           "length": "METRE",
           "area": "METRE²",
@@ -132,10 +198,11 @@ logger = logging.getLogger(__name__)
     - Accurate quantity calculations
     - Common property extraction
     - Optional callback URL for async processing
+    - Parsed files are cached; reuse them with the returned cache_key
     """)
 async def extract_building_elements(
     background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
     page: Optional[int] = Query(1, ge=1, description="Page number (default: 1)"),
     page_size: Optional[int] = Query(50, ge=1, le=10000, description="Items per page (default: 50)"),
     filtered_classes: Optional[List[str]] = Depends(get_ifc_classes),
@@ -144,261 +211,222 @@ async def extract_building_elements(
     exclude_materials: Annotated[bool, Query(description="Exclude material information")] = False,
     exclude_width: Annotated[bool, Query(description="Exclude material widths")] = False,
     exclude_constituent_volumes: Annotated[bool, Query(description="Exclude constituent volumes")] = False,
-    callback_data: CallbackConfigForm = Depends(CallbackConfigForm.as_form)
+    callback_data: CallbackConfigForm = Depends(CallbackConfigForm.as_form),
+    cache_key: Annotated[Optional[str], Query(description="cache_key from a previous response to reuse the already parsed file without uploading it again")] = None
 ):
     """
     Extract detailed information about building elements from an IFC file.
     By default includes all available data except widths and constituent volumes.
     Only specify parameters to override defaults.
     """
-    if not file.filename.endswith('.ifc'):
-        raise HTTPException(status_code=400, detail="Invalid file type. Must be an IFC file.")
-        
-    # Save uploaded file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.ifc') as temp_file:
-        content = await file.read()
-        temp_file.write(content)
-        temp_path = temp_file.name
+    # The upload must outlive this handler when results go to a callback, so
+    # process_and_callback closes the stack once it is done with the file
+    upload_stack = contextlib.AsyncExitStack()
+    temp_path, file_hash = await upload_stack.enter_async_context(ifc_upload(file, cache_key))
 
-    async def process_and_callback():
-        try:
-            ifc_file = ifcopenshell.open(temp_path)
-            units = get_project_units(ifc_file)
-            length_unit = units.get("LENGTHUNIT", {"type": "LENGTHUNIT", "name": "METER"})
-            material_service = MaterialService(ifc_file)
-
-            # Get and filter building elements
-            building_elements = ifc_file.by_type("IfcBuildingElement")
-            if filtered_classes:
-                building_elements = [e for e in building_elements if e.is_a() in filtered_classes]
-
-            total_elements = len(building_elements)
-            total_pages = math.ceil(total_elements / page_size)
-            
-            # Calculate pagination indices
-            start_idx = (page - 1) * page_size
-            end_idx = min(start_idx + page_size, total_elements)
+    options = ExtractOptions(
+        exclude_properties=exclude_properties,
+        exclude_quantities=exclude_quantities,
+        exclude_materials=exclude_materials,
+        exclude_width=exclude_width,
+        exclude_constituent_volumes=exclude_constituent_volumes
+    )
+
+    def open_page() -> Tuple[Dict[str, Any], Iterator[List[Dict[str, Any]]], int]:
+        """Parse the IFC file (or reuse the cached parse) and select the requested page. Runs in a worker thread.
+
+        Returns the response without its elements, an iterator that extracts
+        the page's elements chunk by chunk, and the number of elements on the page.
+        """
+        model = open_upload(file_hash, temp_path)
+        ifc_file = model["ifc"]
+        length_unit = model["units"].get("LENGTHUNIT", {"type": "LENGTHUNIT", "name": "METER"})
+
+        # Get and filter building elements
+        if filtered_classes:
+            # Served from a per-model class index instead of scanning every building element
+            class_index = elements_by_class(model, "IfcBuildingElement")
+            class_lists = [class_index[class_name] for class_name in filtered_classes if class_name in class_index]
+        else:
+            class_lists = [classified_elements(model, "IfcBuildingElement")]
+
+        total_elements = sum(len(class_list) for class_list in class_lists)
+        total_pages = (total_elements + page_size - 1) // page_size
             
-            # Process elements in chunks for progress updates
-            elements = []
-            chunk_size = max(1, total_elements // 10)  # 10% chunks
+        # Calculate pagination indices
+        start_idx = (page - 1) * page_size
+        end_idx = min(start_idx + page_size, total_elements)
             
-            async with httpx.AsyncClient() as client:
-                for i in range(0, total_elements, chunk_size):
-                    chunk = building_elements[i:i + chunk_size]
-                    
-                    # Process chunk
-                    for element in chunk:
-                        element_data = {
-                            "id": element.GlobalId,
-                            "ifc_class": element.is_a(),
-                            "object_type": get_object_type(element)
-                        }
-
-                        if not exclude_properties:
-                            element_data["properties"] = get_common_properties(element)
-
-                        if not exclude_quantities:
-                            quantities = {}
-                            volume = get_volume_from_properties(element)
-                            if volume:
-                                quantities["volume"] = {
-                                    "net": _round_value(volume["net"], 5) if "net" in volume else None,
-                                    "gross": _round_value(volume["gross"], 5) if "gross" in volume else None
-                                }
-                            
-                            area = get_area_from_properties(element)
-                            if area:
-                                quantities["area"] = convert_unit_value(area, length_unit)
-                            
-                            dimensions = get_dimensions_from_properties(element)
-                            if dimensions:
-                                quantities["dimensions"] = {
-                                    "length": _round_value(dimensions["length"]),
-                                    "width": _round_value(dimensions["width"]),
-                                    "height": _round_value(dimensions["height"])
-                                }
-                            
-                            if quantities:
-                                element_data["quantities"] = quantities
-
-                        if not exclude_materials:
-                            materials = material_service.get_element_materials(element)
-                            if materials:
-                                element_data["materials"] = materials
-                                
-                                element_volume = get_volume_from_properties(element)
-                                if isinstance(element_volume, dict):
-                                    element_volume = element_volume.get('net', element_volume.get('value', 0.0))
-                                
-                                if not exclude_constituent_volumes and element_volume:
-                                    material_associations = element.HasAssociations
-                                    has_constituent_volumes = False
-                                    
-                                    for rel in material_associations:
-                                        if rel.is_a('IfcRelAssociatesMaterial'):
-                                            relating_material = rel.RelatingMaterial
-                                            if relating_material.is_a('IfcMaterialConstituentSet'):
-                                                unit_scale = length_unit.get("scale_to_mm", 1.0)
-                                                
-                                                constituent_fractions, constituent_widths = compute_constituent_fractions(
-                                                    ifc_file,
-                                                    relating_material,
-                                                    [element],
-                                                    unit_scale
-                                                )
-                                                
-                                                if constituent_fractions:
-                                                    has_constituent_volumes = True
-                                                    element_data["material_volumes"] = {}
-                                                    total_fraction = 0.0
-                                                    
-                                                    for constituent, fraction in constituent_fractions.items():
-                                                        material_name = constituent.Material.Name if constituent.Material else "Unknown"
-                                                        constituent_volume = float(element_volume) * float(fraction)
-                                                        
-                                                        material_key = material_name
-                                                        counter = 1
-                                                        while material_key in element_data["material_volumes"]:
-                                                            material_key = f"{material_name} ({counter})"
-                                                            counter += 1
-                                                        
-                                                        element_data["material_volumes"][material_key] = {
-                                                            "fraction": _round_value(fraction, 5),
-                                                            "volume": _round_value(convert_unit_value(constituent_volume, length_unit), 5),
-                                                        }
-                                                        if not exclude_width:
-                                                            element_data["material_volumes"][material_key]["width"] = convert_unit_value(constituent_widths[constituent] / 1000.0, length_unit)  # Convert mm to m
-                                                    
-                                                        total_fraction += fraction
-                                                    
-                                                    # Only keep volumes if fractions sum to approximately 1
-                                                    if abs(total_fraction - 1.0) > 0.001:
-                                                        element_data.pop("material_volumes", None)
-
-                                # Fall back to standard material volumes if no constituent volumes were added
-                                if "material_volumes" not in element_data:
-                                    material_volumes = material_service.get_material_volumes(element)
-                                    if material_volumes:
-                                        total_fraction = sum(info["fraction"] for info in material_volumes.values())
-                                        if abs(total_fraction - 1.0) <= 0.001:
-                                            # Get material layer set if available
-                                            material_layer_set = None
-                                            material_layer_usage = None
-                                            for rel in element.HasAssociations:
-                                                if rel.is_a('IfcRelAssociatesMaterial'):
-                                                    relating_material = rel.RelatingMaterial
-                                                    if relating_material.is_a('IfcMaterialLayerSet'):
-                                                        material_layer_set = relating_material
-                                                        break
-                                                    elif relating_material.is_a('IfcMaterialLayerSetUsage'):
-                                                        material_layer_usage = relating_material
-                                                        material_layer_set = relating_material.ForLayerSet
-                                                        if material_layer_set:
-                                                            break
-
-                                            # Create a mapping of material names to their layers
-                                            material_to_layer = {}
-                                            if material_layer_set and material_layer_set.MaterialLayers:
-                                                for layer in material_layer_set.MaterialLayers:
-                                                    if layer.Material:
-                                                        material_to_layer[layer.Material.Name] = layer
-
-                                            element_data["material_volumes"] = {}
-                                            for mat, info in material_volumes.items():
-                                                volume_data = {
-                                                    "fraction": _round_value(info["fraction"], 5),  # 5 digits for fraction
-                                                    "volume": _round_value(convert_unit_value(info["volume"], length_unit), 5)  # 5 digits for volume
-                                                }
-                                                
-                                                # Add width if requested
-                                                if not exclude_width and "width" in info:
-                                                    volume_data["width"] = info["width"]  # Width is already in meters
-                                                
-                                                element_data["material_volumes"][mat] = volume_data
-
-                        elements.append(element_data)
-                    
-                    # Send progress update if callback configured
-                    if callback_data.callback_config:
-                        progress = min(100, int((i + len(chunk)) / total_elements * 100))
-                        if progress % 10 == 0:  # Send update every 10%
-                            try:
-                                await client.post(
-                                    str(callback_data.callback_config.url),
-                                    headers={"Authorization": callback_data.callback_config.token},
-                                    json={
-                                        "status": "processing",
-                                        "progress": progress,
-                                        "total_elements": total_elements,
-                                        "processed_elements": i + len(chunk)
-                                    }
-                                )
-                            except Exception as e:
-                                logger.error(f"Failed to send progress update: {str(e)}")
-
-            # Prepare final response
-            response = {
-                "metadata": {
-                    "total_elements": total_elements,
-                    "total_pages": total_pages,
-                    "current_page": page,
-                    "page_size": page_size,
-                    "ifc_classes": filtered_classes if filtered_classes else [],
-                    "units": {
-                        "length": length_unit["name"],
-                        "area": f"{length_unit['name']}²",
-                        "volume": f"{length_unit['name']}³"
-                    }
-                },
-                "model_info": get_model_metadata(ifc_file),
-                "elements": elements[start_idx:end_idx]  # Only return requested page
-            }
+        # Only the requested page is extracted; elements outside it are never
+        # touched, and the class lists are not concatenated to find it
+        page_elements = list(page_window(class_lists, start_idx, end_idx))
+        page_count = len(page_elements)
+
+        # Process elements in chunks for progress updates
+        chunk_size = max(1, page_count // 10)  # 10% chunks
+        chunks = [page_elements[i:i + chunk_size] for i in range(0, page_count, chunk_size)]
+
+        def extract_chunks() -> Iterator[List[Dict[str, Any]]]:
+            if temp_path and page_count >= PARALLEL_MIN_ELEMENTS:
+                # Large pages are spread over worker processes, which reopen the upload from disk
+                element_refs = [[(element.id(), ifc_class) for element, ifc_class in chunk] for chunk in chunks]
+                yield from _get_extract_pool().map(
+                    extract_chunk,
+                    itertools.repeat(temp_path),
+                    itertools.repeat(file_hash),
+                    element_refs,
+                    itertools.repeat(options)
+                )
+                return
+
+            rounder = BatchRounder()
+            extractor = ElementExtractor(model, options, rounder)
+            for chunk in chunks:
+                chunk_elements = [extractor.build(element, ifc_class) for element, ifc_class in chunk]
+                # Round the chunk's quantities in one vectorized pass
+                rounder.flush()
+                yield chunk_elements
+
+        # Response without the elements, which are added or streamed after it
+        response = {
+            "metadata": {
+                "total_elements": total_elements,
+                "total_pages": total_pages,
+                "current_page": page,
+                "page_size": page_size,
+                "ifc_classes": filtered_classes if filtered_classes else [],
+                "cache_key": file_hash,
+                "units": {
+                    "length": length_unit["name"],
+                    "area": f"{length_unit['name']}²",
+                    "volume": f"{length_unit['name']}³"
+                }
+            },
+            "model_info": get_model_metadata(ifc_file)
+        }
+
+        return response, extract_chunks(), page_count
+
+    def process_elements(on_progress) -> Dict[str, Any]:
+        """Extract the whole page into the response. Runs in a worker thread."""
+        response, element_chunks, page_count = open_page()
+        total_elements = response["metadata"]["total_elements"]
+        elements = []
+        for chunk_elements in element_chunks:
+            elements.extend(chunk_elements)
+            on_progress(len(elements), page_count, total_elements)
+        response["elements"] = elements
+        return response
+
+    async def stream_page(response: Dict[str, Any], element_chunks: Iterator[List[Dict[str, Any]]]):
+        """Stream the page's JSON while its elements are extracted, chunk by chunk.
+
+        The chunks are produced on a worker thread, which stops when the
+        client goes away. The upload is kept until the stream ends, since
+        worker processes may still be reading it.
+        """
+        try:
+            async for data in iterate_in_thread(iter_json_batches(response, "elements", element_chunks)):
+                yield data
+        except Exception as e:
+            # The status line has been sent; the truncated body tells the client it failed
+            logger.error(f"Error streaming building elements: {str(e)}")
+            raise
+        finally:
+            await upload_stack.aclose()
+
+    async def post_callback(payload: Dict[str, Any], description: str):
+        """Send a payload to the configured callback URL, logging failures."""
+        try:
+            await get_callback_client().post(
+                str(callback_data.callback_config.url),
+                headers={"Authorization": callback_data.callback_config.token, "Content-Type": "application/json"},
+                content=orjson.dumps(payload, option=ORJSON_OPTIONS)
+            )
+        except Exception as e:
+            logger.error(f"Failed to send {description}: {str(e)}")
+
+    async def process_and_callback():
+        loop = asyncio.get_running_loop()
+        try:
+            progress_updates = []
+            last_bucket = -1
+
+            def on_progress(processed: int, page_count: int, total_elements: int):
+                # Called from the worker thread; schedule the POST on the event loop
+                # without waiting for it, so extraction never blocks on the network
+                nonlocal last_bucket
+                if not callback_data.callback_config:
+                    return
+                progress = min(100, int(processed / page_count * 100))
+                # Send an update whenever a new 10% step is reached; chunk sizes
+                # rarely land exactly on a multiple of 10
+                bucket = progress // 10
+                if bucket != last_bucket:
+                    last_bucket = bucket
+                    progress_updates.append(asyncio.run_coroutine_threadsafe(
+                        post_callback({
+                            "status": "processing",
+                            "progress": progress,
+                            # Progress is through the requested page; total_elements
+                            # is the model total, as in the final result's metadata
+                            "total_elements": total_elements,
+                            "page_elements": page_count,
+                            "processed_elements": processed
+                        }, "progress update"),
+                        loop
+                    ))
+
+            response = await asyncio.to_thread(process_elements, on_progress)
+
+            # Progress posts have been running alongside extraction; wait for the stragglers together
+            await asyncio.gather(*(asyncio.wrap_future(update) for update in progress_updates), return_exceptions=True)
 
             # Send final result if callback configured
             if callback_data.callback_config:
-                try:
-                    await client.post(
-                        str(callback_data.callback_config.url),
-                        headers={"Authorization": callback_data.callback_config.token},
-                        json={
-                            "status": "completed",
-                            "progress": 100,
-                            "result": response
-                        }
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send final result: {str(e)}")
-            
+                await post_callback({
+                    "status": "completed",
+                    "progress": 100,
+                    "result": response
+                }, "final result")
+
             return response
 
         except Exception as e:
             error_msg = str(e)
             logger.error(f"Error processing IFC file: {error_msg}")
             if callback_data.callback_config:
-                try:
-                    async with httpx.AsyncClient() as client:
-                        await client.post(
-                            str(callback_data.callback_config.url),
-                            headers={"Authorization": callback_data.callback_config.token},
-                            json={
-                                "status": "error",
-                                "error": error_msg
-                            }
-                        )
-                except Exception as callback_error:
-                    logger.error(f"Failed to send error update: {str(callback_error)}")
+                await post_callback({
+                    "status": "error",
+                    "error": error_msg
+                }, "error update")
             raise HTTPException(status_code=400, detail=error_msg)
         finally:
             # Cleanup temp file
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
+            await upload_stack.aclose()
 
     if callback_data.callback_config:
         # Start processing in background and return immediately
         task_id = generate_unique_id()
         background_tasks.add_task(process_and_callback)
-        return {"task_id": task_id, "message": "Processing started. Results will be sent to callback URL."}
+        return ORJSONResponse({"task_id": task_id, "message": "Processing started. Results will be sent to callback URL."})
     else:
-        # Process synchronously and return result
-        return await process_and_callback()
\ No newline at end of file
+        # Stream the page as its elements are extracted, so the first bytes go
+        # out before the whole page is built. The file is parsed and the page
+        # selected before the response starts, so invalid files still get a 400.
+        try:
+            response, element_chunks, _ = await asyncio.to_thread(open_page)
+        except HTTPException:
+            await upload_stack.aclose()
+            raise
+        except Exception as e:
+            await upload_stack.aclose()
+            logger.error(f"Error processing IFC file: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+        # The upload is also closed as a background task, for a response that
+        # is dropped before its stream starts; closing it again is a no-op
+        return StreamingResponse(
+            stream_page(response, element_chunks),
+            media_type="application/json",
+            background=BackgroundTask(upload_stack.aclose)
+        )
\ No newline at end of file
@@ -1,21 +1,36 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from pydantic import BaseModel
-from typing import List, Optional
-import tempfile
-import os
+from typing import Iterator, List, Optional, Tuple
+import multiprocessing
 import logging
+import asyncio
 import numpy as np
+import base64
 import uuid
 import ifcopenshell
 import ifcopenshell.geom
+from collections import OrderedDict
+import threading
+from app.services.ifc.cache import ifc_file_cache
+from .common import spool_upload
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Mesh buffers are sent as base64 little-endian binary instead of JSON number lists
+VERTEX_DTYPE = np.dtype('<f4')
+INDEX_DTYPE = np.dtype('<u4')
+
+def encode_buffer(array: np.ndarray, dtype: np.dtype) -> str:
+    """Base64 encode an array as a flat buffer of the given dtype."""
+    return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode('ascii')
+
 class Mesh(BaseModel):
-    vertices: List[List[float]]
-    indices: List[int]
-    normals: Optional[List[List[float]]]
+    vertices: str  # base64 float32 buffer, x, y, z per vertex
+    indices: str  # base64 uint32 buffer, 3 indices per triangle
+    normals: Optional[str]  # base64 float32 buffer, x, y, z per vertex
+    vertex_count: int
+    index_count: int
     colors: Optional[List[List[float]]]
     material_id: Optional[str]
 
@@ -26,69 +41,134 @@ class ProcessedIFC(BaseModel):
 
 def calculate_normals(vertices: np.ndarray, faces: np.ndarray) -> np.ndarray:
     """Calculate vertex normals for a mesh."""
-    normals = np.zeros_like(vertices)
-    
-    for face in faces:
-        v0, v1, v2 = vertices[face]
-        normal = np.cross(v1 - v0, v2 - v0)
-        normals[face] += normal
+    vertex_count = len(vertices)
+    normals = np.empty((vertex_count, 3), dtype=np.float64)
+
+    # Face normals for all triangles at once, without an (F, 3, 3) triangle copy
+    v0 = vertices[faces[:, 0]]
+    face_normals = np.cross(vertices[faces[:, 1]] - v0, vertices[faces[:, 2]] - v0)
+
+    # Sum face normals onto their vertices; bincount is a single pass per axis,
+    # unlike the unbuffered scatter of np.add.at
+    vertex_ids = faces.ravel()
+    corner_normals = np.repeat(face_normals, 3, axis=0)
+    for axis in range(3):
+        normals[:, axis] = np.bincount(vertex_ids, weights=corner_normals[:, axis], minlength=vertex_count)
     
     # Normalize
     norms = np.linalg.norm(normals, axis=1)
     norms[norms == 0] = 1
-    normals = normals / norms[:, np.newaxis]
+    normals /= norms[:, np.newaxis]
     
     return normals
 
-def process_ifc_geometry(file_path: str) -> ProcessedIFC:
-    """Process an IFC file and extract geometry data."""
-    ifc_file = ifcopenshell.open(file_path)
+# Tessellated results of the most recent uploads, keyed by content hash;
+# re-sending the same file returns them without tessellating again
+MAX_CACHED_GEOMETRY = 2
+_geometry_cache: "OrderedDict[str, ProcessedIFC]" = OrderedDict()
+_geometry_cache_lock = threading.Lock()
+
+def _get_cached_geometry(file_hash: str) -> Optional[ProcessedIFC]:
+    with _geometry_cache_lock:
+        result = _geometry_cache.get(file_hash)
+        if result is not None:
+            _geometry_cache.move_to_end(file_hash)
+        return result
+
+def _cache_geometry(file_hash: str, result: ProcessedIFC):
+    with _geometry_cache_lock:
+        _geometry_cache[file_hash] = result
+        _geometry_cache.move_to_end(file_hash)
+        while len(_geometry_cache) > MAX_CACHED_GEOMETRY:
+            _geometry_cache.popitem(last=False)
+
+def mesh_arrays(geometry) -> Tuple[np.ndarray, np.ndarray]:
+    """Get (vertices, faces) of a triangulation as (N, 3) arrays.
+
+    Reads ifcopenshell's raw buffers where available instead of converting a
+    tuple of Python numbers entry by entry.
+    """
+    verts_buffer = getattr(geometry, "verts_buffer", None)
+    faces_buffer = getattr(geometry, "faces_buffer", None)
+    if verts_buffer is not None and faces_buffer is not None:
+        if callable(verts_buffer):
+            verts_buffer, faces_buffer = verts_buffer(), faces_buffer()
+        verts = np.frombuffer(verts_buffer, dtype=np.float64)
+        faces = np.frombuffer(faces_buffer, dtype=np.int32)
+    else:
+        verts = np.fromiter(geometry.verts, dtype=np.float64, count=len(geometry.verts))
+        faces = np.fromiter(geometry.faces, dtype=np.int64, count=len(geometry.faces))
+    return verts.reshape(-1, 3), faces.reshape(-1, 3)
+
+def iterate_shapes(settings, ifc_file) -> Iterator:
+    """Yield the triangulated shapes of all products with geometry.
+
+    The geometry iterator tessellates on one thread per core, unlike calling
+    create_shape for one product at a time.
+    """
+    iterator = ifcopenshell.geom.iterator(settings, ifc_file, multiprocessing.cpu_count())
+    if not iterator.initialize():
+        return
+    while True:
+        yield iterator.get()
+        if not iterator.next():
+            break
+
+def process_ifc_geometry(file_path: str, file_hash: Optional[str] = None) -> ProcessedIFC:
+    """Process an IFC file and extract geometry data.
+
+    With a file_hash the parse is shared with the other endpoints through the IFC file cache.
+    """
+    ifc_file = ifc_file_cache.open(file_hash, file_path)["ifc"] if file_hash else ifcopenshell.open(file_path)
     settings = ifcopenshell.geom.settings()
     settings.set(settings.USE_WORLD_COORDS, True)
+    settings.set(settings.WELD_VERTICES, True)
     
     meshes: List[Mesh] = []
-    min_bounds = np.array([float('inf')] * 3)
-    max_bounds = np.array([float('-inf')] * 3)
+    # Per-mesh bounds, reduced once after the loop
+    mesh_mins: List[np.ndarray] = []
+    mesh_maxs: List[np.ndarray] = []
     
-    for product in ifc_file.by_type("IfcProduct"):
-        if not product.Representation:
-            continue
-            
+    for shape in iterate_shapes(settings, ifc_file):
         try:
-            # Create shape from product
-            shape = ifcopenshell.geom.create_shape(settings, product)
-            
             # Get geometry data from shape
             geometry = shape.geometry
             if not geometry:
                 continue
                 
             # Extract vertices and faces
-            verts = np.array(geometry.verts).reshape(-1, 3)
-            faces = np.array(geometry.faces).reshape(-1, 3)
+            verts, faces = mesh_arrays(geometry)
             
             # Update bounds
-            min_bounds = np.minimum(min_bounds, verts.min(axis=0))
-            max_bounds = np.maximum(max_bounds, verts.max(axis=0))
+            mesh_mins.append(verts.min(axis=0))
+            mesh_maxs.append(verts.max(axis=0))
             
             # Calculate normals
             normals = calculate_normals(verts, faces)
             
             meshes.append(Mesh(
-                vertices=verts.tolist(),
-                indices=faces.flatten().tolist(),
-                normals=normals.tolist(),
+                vertices=encode_buffer(verts, VERTEX_DTYPE),
+                indices=encode_buffer(faces, INDEX_DTYPE),
+                normals=encode_buffer(normals, VERTEX_DTYPE),
+                vertex_count=len(verts),
+                index_count=faces.size,
                 colors=None,
                 material_id=str(uuid.uuid4())
             ))
         except Exception as e:
-            logger.error(f"Error processing element {product.id()}: {e}")
+            logger.error(f"Error processing element {shape.id}: {e}")
             continue
     
     # Handle case where no valid geometry was found
-    if len(meshes) == 0 or np.any(np.isinf(min_bounds)) or np.any(np.isinf(max_bounds)):
+    if len(meshes) == 0 or not mesh_mins:
         min_bounds = np.zeros(3)
         max_bounds = np.zeros(3)
+    else:
+        min_bounds = np.stack(mesh_mins).min(axis=0)
+        max_bounds = np.stack(mesh_maxs).max(axis=0)
+        if np.any(np.isinf(min_bounds)) or np.any(np.isinf(max_bounds)):
+            min_bounds = np.zeros(3)
+            max_bounds = np.zeros(3)
     
     return ProcessedIFC(
         meshes=meshes,
@@ -109,9 +189,11 @@ def process_ifc_geometry(file_path: str) -> ProcessedIFC:
     {
       "meshes": [
         {
-          "vertices": [[x1,y1,z1], [x2,y2,z2], ...],  // 3D coordinates
-          "indices": [i1,i2,i3, ...],                  // Triangular faces (3 indices per face)
-          "normals": [[nx1,ny1,nz1], ...],            // Normal vectors for lighting
+          "vertices": "AACAPwAAAEA...",              // base64 float32 x,y,z per vertex
+          "indices": "AAAAAAEAAAA...",               // base64 uint32, 3 indices per face
+          "normals": "AAAAAAAAAAA...",               // base64 float32 normal per vertex
+          "vertex_count": 24,                         // Number of vertices
+          "index_count": 36,                          // Number of indices
           "colors": null,                              // Optional vertex colors
           "material_id": "uuid"                        // Unique identifier for material
         },
@@ -126,6 +208,8 @@ def process_ifc_geometry(file_path: str) -> ProcessedIFC:
     ```
     
     Technical Details:
+    - Buffers: Base64 encoded little-endian binary; decode with e.g.
+      `new Float32Array(bytes.buffer)` or `np.frombuffer(data, '<f4').reshape(-1, 3)`
     - Vertices: World coordinates in model units
     - Indices: Zero-based indices forming triangular faces
     - Normals: Unit vectors for surface lighting calculations
@@ -145,21 +229,18 @@ async def process_geometry(file: UploadFile = File(...)) -> ProcessedIFC:
     if not file.filename.endswith('.ifc'):
         raise HTTPException(status_code=400, detail="Invalid file type. Must be an IFC file.")
         
-    # Save uploaded file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.ifc') as temp_file:
-        content = await file.read()
-        temp_file.write(content)
-        temp_path = temp_file.name
-
-    try:
-        # Process file geometry
-        result = process_ifc_geometry(temp_path)
-        return result
-    
-    except Exception as e:
-        logger.error(f"Error processing IFC geometry: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Cleanup
-        if os.path.exists(temp_path):
-            os.unlink(temp_path) 
\ No newline at end of file
+    # Stream the upload to disk in chunks instead of reading it into memory
+    async with spool_upload(file) as (temp_path, file_hash):
+        result = _get_cached_geometry(file_hash)
+        if result is not None:
+            return result
+
+        try:
+            # Process file geometry in a worker thread so the event loop stays responsive
+            result = await asyncio.to_thread(process_ifc_geometry, temp_path, file_hash)
+            _cache_geometry(file_hash, result)
+            return result
+        
+        except Exception as e:
+            logger.error(f"Error processing IFC geometry: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
@@ -1,20 +1,23 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi import APIRouter, UploadFile, File, HTTPException, Query, Request
 from fastapi.responses import StreamingResponse
-import tempfile
-import os
-import json
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import orjson
+import asyncio
+import contextlib
 import logging
-import ifcopenshell
+import threading
+import zlib
 from app.services.ifc.properties import get_common_properties, get_object_type
 from app.services.ifc.quantities import (
     get_volume_from_properties,
     get_area_from_properties,
     get_dimensions_from_properties,
+    get_volumes_from_geometry,
     clear_quantity_caches
 )
-from app.services.lca.materials import MaterialService
-from app.services.ifc.units import get_project_units, convert_unit_value
-from .common import _round_value
+from app.services.ifc.cache import ifc_file_cache, classified_elements, material_service_for, property_index_for
+from app.services.ifc.units import get_unit_factor
+from .common import BatchRounder, ORJSON_OPTIONS, buffer_upload, iterate_in_thread
 import gc
 
 router = APIRouter()
@@ -23,6 +26,217 @@ logger = logging.getLogger(__name__)
 # Maximum file size (50MB)
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB in bytes
 
+# Elements are rounded, streamed and their caches cleared in batches of this size
+STREAM_BATCH_SIZE = 50
+
+# Progress lines per stream: one every total/PROGRESS_STEPS elements (every 5%),
+# but at least MIN_PROGRESS_STEP elements apart, so small files that finish
+# in a moment are not padded with progress lines
+PROGRESS_STEPS = 20
+MIN_PROGRESS_STEP = 100
+
+# Stream output is sent once this many bytes are buffered
+STREAM_FLUSH_SIZE = 64 * 1024
+
+# Fixed-shape stream lines, filled in with %-formatting instead of being serialized
+_ELEMENT_PREFIX = b'{"status":"element","data":'
+_ELEMENT_SUFFIX = b'}\n'
+_PROGRESS_TEMPLATE = b'{"status": "processing", "progress": %.1f, "processed": %d, "total": %d}\n'
+_COMPLETE_TEMPLATE = b'{"status": "complete", "count": %d}\n'
+
+# Number of streams running with the cyclic garbage collector paused
+_gc_pause_count = 0
+_gc_pause_lock = threading.Lock()
+_gc_was_enabled = False
+
+def _pause_gc():
+    """Disable the cyclic garbage collector while a batch is extracted.
+
+    A full collection walks every object ifcopenshell keeps alive for a large
+    model and blocks the event loop while it does; the batch's own objects are
+    freed by reference counting.
+    """
+    global _gc_pause_count, _gc_was_enabled
+    with _gc_pause_lock:
+        if _gc_pause_count == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pause_count += 1
+
+def _resume_gc():
+    """Re-enable the garbage collector once the last paused batch is done."""
+    global _gc_pause_count
+    with _gc_pause_lock:
+        _gc_pause_count -= 1
+        if _gc_pause_count == 0 and _gc_was_enabled:
+            gc.enable()
+
+@contextlib.contextmanager
+def _gc_paused():
+    """Pause the garbage collector for the CPU work inside the block.
+
+    The collector is paused process-wide, so it must not stay paused across a
+    stream's yields, where a slow client would keep it off for every request.
+    """
+    _pause_gc()
+    try:
+        yield
+    finally:
+        _resume_gc()
+
+# gzip level for /process streams; NDJSON elements repeat the same keys, so
+# even a fast level shrinks them several times over
+STREAM_GZIP_LEVEL = 5
+
+def _coding_quality(params: str) -> float:
+    """The q value of an Accept-Encoding entry's parameters (1 when not given, 0 when malformed)."""
+    for param in params.split(';'):
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip.
+
+    An explicit gzip entry takes precedence over "*"; either one refuses
+    gzip with q=0.
+    """
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        name = name.strip().lower()
+        if name in ('gzip', '*'):
+            qualities[name] = _coding_quality(params)
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+def _gzip_chunks(chunks: Iterator[bytes], level: int = STREAM_GZIP_LEVEL) -> Iterator[bytes]:
+    """gzip a stream of chunks, flushing after each one so it reaches the client right away."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def _render_batch(
+    batch: List[Tuple[Dict[str, Any], int]],
+    rounder: BatchRounder,
+    total_elements: int,
+    progress_step: int,
+    buffer: bytearray
+):
+    """Round a batch of elements in one pass and append their element and progress lines to buffer.
+
+    A progress line follows every progress_step-th element and the last one.
+    """
+    rounder.flush()
+    for element_data, processed in batch:
+        # Stream each element
+        buffer += _ELEMENT_PREFIX
+        buffer += orjson.dumps(element_data, option=ORJSON_OPTIONS)
+        buffer += _ELEMENT_SUFFIX
+        
+        # Yield progress, computed only when it is sent
+        if processed % progress_step == 0 or processed == total_elements:
+            buffer += _PROGRESS_TEMPLATE % ((processed / total_elements) * 100, processed, total_elements)
+
+def _empty_quantities() -> Tuple[Dict, Dict, Dict]:
+    """Volume, area and dimensions of an element in a model without property definitions."""
+    return (
+        {"net": None, "gross": None},
+        {"net": None, "gross": None},
+        {"length": None, "width": None, "height": None}
+    )
+
+# Shared empty mapping for leaving optional keys out of an element literal
+_NO_ITEMS: Dict[str, Any] = {}
+
+def _scale_material_volumes(material_volumes: Dict[str, Dict], unit_factor: float) -> Dict[str, Dict]:
+    """Convert the volume and width of each material with the project's unit factor."""
+    scaled = {}
+    for material, info in material_volumes.items():
+        width = info.get("width")
+        scaled[material] = {
+            "volume": info["volume"] * unit_factor,
+            "fraction": info["fraction"],
+            "width": None if width is None else width * unit_factor
+        }
+    return scaled
+
+def _build_element(
+    element_id: int,
+    ifc_class: str,
+    properties: Dict,
+    object_type: Optional[str],
+    volume: Optional[Dict],
+    area: Optional[Dict],
+    dimensions: Optional[Dict],
+    materials: Optional[List[str]],
+    material_volumes: Optional[Dict],
+    unit_factor: float,
+    rounder: BatchRounder
+) -> Dict[str, Any]:
+    """Build the data of one element as a single dict literal.
+
+    Optional parts are left out when the element has no data for them, in the
+    same key order as before, so the dict is created at its final size.
+    """
+    volume_data = None
+    if volume:
+        volume_data = {}
+        rounder.set(volume_data, "net", volume["net"] if "net" in volume else None, 5)
+        rounder.set(volume_data, "gross", volume["gross"] if "gross" in volume else None, 5)
+
+    dimensions_data = None
+    if dimensions:
+        dimensions_data = {}
+        for key in ("length", "width", "height"):
+            rounder.set(dimensions_data, key, dimensions[key])
+
+    return {
+        "id": element_id,
+        "ifc_entity": ifc_class,
+        "properties": properties,
+        "object_type": object_type,
+        **({"volume": volume_data} if volume_data is not None else _NO_ITEMS),
+        **({"area": {key: value * unit_factor for key, value in area.items() if value is not None}} if area else _NO_ITEMS),
+        **({"dimensions": dimensions_data} if dimensions_data is not None else _NO_ITEMS),
+        **({"materials": materials} if materials else _NO_ITEMS),
+        **({"material_volumes": _scale_material_volumes(material_volumes, unit_factor)}
+           if materials and material_volumes else _NO_ITEMS),
+    }
+
+def _load_model(temp_path: Optional[str], file_hash: str, geometry_volumes: bool = False, content: Optional[str] = None):
+    """Parse an uploaded IFC file and build everything the stream needs from it.
+
+    The upload is parsed from content when it was kept in memory, otherwise
+    from temp_path. The parsed model, its units and indexes come from the IFC
+    file cache, so uploading the same file again skips the parse and indexing.
+    """
+    model = ifc_file_cache.open(file_hash, temp_path, content)
+    ifc_file = model["ifc"]
+    length_unit = model["units"].get("LENGTHUNIT", {"type": "LENGTHUNIT", "name": "METER"})
+    # Resolved once instead of per converted value
+    unit_factor = get_unit_factor(length_unit)
+    material_service = material_service_for(model)
+    # Quantity sets of every element, indexed in one pass over the model
+    property_index = property_index_for(model)
+    # (product, class) pairs queried once for both the count and the walk, so
+    # the stream does not ask ifcopenshell for every element's class again
+    products = classified_elements(model, "IfcProduct")
+
+    # Volumes of the products without volume quantities, computed from their
+    # geometry in one parallel pass before streaming starts
+    fallback_volumes = {}
+    if geometry_volumes:
+        fallback_volumes = get_volumes_from_geometry(ifc_file, (
+            element for element, _ in products
+            if not any(get_volume_from_properties(element, property_index).values())
+        ))
+    return ifc_file, unit_factor, material_service, property_index, products, fallback_volumes
+
 @router.post("/process", 
     summary="Stream Building Element Analysis",
     description="""
@@ -30,197 +244,191 @@ MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB in bytes
     
     The response is streamed as a series of JSON objects, each on a new line:
     
-    1. Progress updates during processing:
-    ```json
-    {"status": "processing", "progress": 25.5, "processed": 50, "total": 196}
-    ```
-    
-    2. Final result with complete element data:
+    1. One line per element as soon as it is processed:
     ```json
     {
-      "status": "complete",
-      "elements": [
-        {
-          "id": "489",
-          "ifc_entity": "IfcBeam",
-          "properties": {
-            "loadBearing": true,
-            "isExternal": false
-          },
-          "object_type": "Beam Type",
-          "volume": {
-            "net": null,
-            "gross": 0.09863
-          },
-          "area": {},
-          "dimensions": {
-            "length": 2476.229,
-            "width": null,
-            "height": null
-          },
-          "materials": ["wood - pine"],
-          "material_volumes": {
-            "wood - pine": {
-              "volume": 9.863e-05,
-              "fraction": 1.0,
-              "width": null
-            }
+      "status": "element",
+      "data": {
+        "id": 489,
+        "ifc_entity": "IfcBeam",
+        "properties": {
+          "loadBearing": true,
+          "isExternal": false
+        },
+        "object_type": "Beam Type",
+        "volume": {
+          "net": null,
+          "gross": 0.09863
+        },
+        "area": {},
+        "dimensions": {
+          "length": 2476.229,
+          "width": null,
+          "height": null
+        },
+        "materials": ["wood - pine"],
+        "material_volumes": {
+          "wood - pine": {
+            "volume": 9.863e-05,
+            "fraction": 1.0,
+            "width": null
           }
         }
-      ]
+      }
     }
     ```
     
+    2. Progress updates after every 5% of the elements (at most one per 100 elements):
+    ```json
+    {"status": "processing", "progress": 51.0, "processed": 100, "total": 196}
+    ```
+    
+    3. A final line with the number of elements sent; no element is held back for it:
+    ```json
+    {"status": "complete", "count": 196}
+    ```
+    
     The streamed format allows for real-time progress monitoring and handling of large IFC files.
     Each line is a complete JSON object that can be parsed independently.
     """)
-async def process_ifc(file: UploadFile = File(...)) -> StreamingResponse:
+async def process_ifc(
+    request: Request,
+    file: UploadFile = File(...),
+    geometry_volumes: bool = Query(
+        default=False,
+        description="Compute the volume from the geometry for elements without volume quantities or properties"
+    )
+) -> StreamingResponse:
     """Process an IFC file and stream the results"""
     if not file.filename.endswith('.ifc'):
         raise HTTPException(status_code=400, detail="Invalid file type. Must be an IFC file.")
     
-    # Check file size before processing
-    file_size = 0
-    temp_file = None
-    temp_path = None
-    
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.ifc') as temp_file:
-            temp_path = temp_file.name
-            chunk_size = 8192  # 8KB chunks
-            
-            while chunk := await file.read(chunk_size):
-                file_size += len(chunk)
-                if file_size > MAX_FILE_SIZE:
-                    # Clean up and raise error
-                    temp_file.close()
-                    os.unlink(temp_path)
-                    raise HTTPException(
-                        status_code=413,
-                        detail=f"File too large. Maximum size is {MAX_FILE_SIZE/1024/1024:.1f}MB"
-                    )
-                temp_file.write(chunk)
-            
-            # Rewind file for reading
-            temp_file.flush()
+        # Small files are parsed straight from memory; larger ones are copied in
+        # 1MB chunks, rejecting files over the size limit as they arrive. The
+        # content hash finds an already parsed copy of the file. The temp file
+        # is only needed until the model is parsed.
+        async with buffer_upload(file, MAX_FILE_SIZE) as (temp_path, content, file_hash):
+            # Parsing and indexing block for seconds on large models, so they run
+            # on a worker thread and leave the event loop free for other requests
+            ifc_file, unit_factor, material_service, property_index, products, fallback_volumes = await asyncio.to_thread(
+                _load_model, temp_path, file_hash, geometry_volumes, content
+            )
         
-        ifc_file = ifcopenshell.open(temp_path)
-        units = get_project_units(ifc_file)
-        length_unit = units.get("LENGTHUNIT", {"type": "LENGTHUNIT", "name": "METER"})
-        material_service = MaterialService(ifc_file)
-        
-        async def generate_response():
-            try:
-                # Clear caches before processing
-                clear_quantity_caches()
-                clear_property_caches()
-                gc.collect()
-                
-                total_elements = len(ifc_file.by_type("IfcProduct"))
-                processed = 0
-                
-                for element in ifc_file.by_type("IfcProduct"):
-                    try:
-                        element_data = {
-                            "id": element.id(),
-                            "ifc_entity": element.is_a(),
-                            "properties": get_common_properties(element),
-                            "object_type": get_object_type(element)
-                        }
-
-                        volume = get_volume_from_properties(element)
-                        if volume:
-                            element_data["volume"] = {
-                                "net": _round_value(volume["net"], 5) if "net" in volume else None,
-                                "gross": _round_value(volume["gross"], 5) if "gross" in volume else None
-                            }
-                        
-                        area = get_area_from_properties(element)
-                        if area:
-                            element_data["area"] = convert_unit_value(area, length_unit)
-                        
-                        dimensions = get_dimensions_from_properties(element)
-                        if dimensions:
-                            element_data["dimensions"] = {
-                                "length": _round_value(dimensions["length"]),
-                                "width": _round_value(dimensions["width"]),
-                                "height": _round_value(dimensions["height"])
-                            }
-
-                        materials = material_service.get_element_materials(element)
-                        if materials:
-                            element_data["materials"] = materials
-                            material_volumes = material_service.get_material_volumes(element)
-                            if material_volumes:
-                                element_data["material_volumes"] = {
-                                    mat: {
-                                        "volume": convert_unit_value(info["volume"], length_unit),
-                                        "fraction": info["fraction"],
-                                        "width": convert_unit_value(info["width"], length_unit) if "width" in info else None
-                                    }
-                                    for mat, info in material_volumes.items()
-                                }
-                        
-                        # Stream each element immediately
-                        yield json.dumps({
-                            "status": "element",
-                            "data": element_data
-                        }) + "\n"
-                        
+        def extract_batch(elements) -> List[Tuple]:
+            """Look up the quantities, materials and properties of a batch of (element, class) pairs.
+
+            The element dicts are built and rounded from the returned tuples
+            afterwards, one batch at a time.
+            """
+            has_psets = len(property_index) > 0
+            has_materials = material_service.has_materials()
+            # Per-element functions bound to locals once instead of looked up on every element
+            volume_of = get_volume_from_properties
+            area_of = get_area_from_properties
+            dimensions_of = get_dimensions_from_properties
+            relating_materials_of = material_service.get_relating_materials
+            materials_of = material_service.get_element_materials
+            material_volumes_of = material_service.get_material_volumes
+            common_properties_of = get_common_properties
+            object_type_of = get_object_type
+
+            extracted = []
+            append = extracted.append
+            for element, ifc_class in elements:
+                try:
+                    element_id = element.id()
+                    if has_psets:
+                        volume = volume_of(element, property_index)
+                        area = area_of(element, property_index)
+                        dimensions = dimensions_of(element, property_index)
+                    else:
+                        volume, area, dimensions = _empty_quantities()
+                    if fallback_volumes and element_id in fallback_volumes:
+                        volume = {"net": fallback_volumes[element_id], "gross": None}
+
+                    if has_materials:
+                        relating_materials = relating_materials_of(element)
+                        materials = materials_of(element, relating_materials)
+                    else:
+                        materials = None
+                    material_volumes = material_volumes_of(element, volume, dimensions, relating_materials) if materials else None
+
+                    append((
+                        element_id, ifc_class, common_properties_of(element, property_index, ifc_class),
+                        object_type_of(element), volume, area, dimensions, materials, material_volumes
+                    ))
+                except Exception as e:
+                    logger.error(f"Error processing element {element.id()}: {str(e)}")
+            return extracted
+
+        def generate_chunks():
+            # Clear caches before processing
+            clear_quantity_caches()
+
+            total_elements = len(products)
+            progress_step = max(MIN_PROGRESS_STEP, total_elements // PROGRESS_STEPS)
+            processed = 0
+            # Elements are rounded with NumPy in batches before they are streamed
+            rounder = BatchRounder()
+            batch = []
+            buffer = bytearray()
+            first_batch = True
+            build_element = _build_element
+
+            for start in range(0, total_elements, STREAM_BATCH_SIZE):
+                # The collector is only paused while the batch is built, not
+                # while the stream waits for the client
+                with _gc_paused():
+                    extracted = extract_batch(products[start:start + STREAM_BATCH_SIZE])
+                    for element_id, ifc_class, properties, object_type, volume, area, dimensions, materials, material_volumes in extracted:
+                        element_data = build_element(
+                            element_id, ifc_class, properties, object_type, volume, area, dimensions,
+                            materials, material_volumes, unit_factor, rounder
+                        )
                         processed += 1
-                        if processed % 50 == 0:
-                            # Clear caches periodically during processing
-                            clear_quantity_caches()
-                            clear_property_caches()
-                            gc.collect()
-                            
-                        # Yield progress
-                        progress = (processed / total_elements) * 100
-                        yield f'{{"status": "processing", "progress": {progress:.1f}, "processed": {processed}, "total": {total_elements}}}\n'
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing element {element.id()}: {str(e)}")
-                        continue
-                
-                # Clear caches after processing
+                        batch.append((element_data, processed))
+
+                    _render_batch(batch, rounder, total_elements, progress_step, buffer)
+                    batch.clear()
+                # Send in large chunks rather than one ASGI message per line,
+                # but send the first batch right away so clients see progress
+                if len(buffer) >= STREAM_FLUSH_SIZE or first_batch:
+                    first_batch = False
+                    yield bytes(buffer)
+                    buffer.clear()
+
+                # Clear caches periodically to bound their memory
                 clear_quantity_caches()
-                clear_property_caches()
-                gc.collect()
-                
-                # Yield final result
-                yield '{"status": "complete"}\n'
-                
-            finally:
-                # Clean up temp file and clear memory
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.unlink(temp_path)
-                    except Exception as e:
-                        logger.error(f"Error cleaning up temp file: {str(e)}")
-                
-                # Force garbage collection
-                gc.collect()
+
+            # Yield final result
+            buffer += _COMPLETE_TEMPLATE % processed
+            yield bytes(buffer)
+
+        headers = {
+            "X-Content-Type-Options": "nosniff",
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding"
+        }
+        chunks = generate_chunks()
+        # Compressed here rather than by a middleware: each chunk is flushed so
+        # progress lines are not held back, and the compression runs on the
+        # stream's thread instead of the event loop
+        if _accepts_gzip(request.headers.get("accept-encoding", "")):
+            headers["Content-Encoding"] = "gzip"
+            chunks = _gzip_chunks(chunks)
 
         return StreamingResponse(
-            generate_response(),
+            iterate_in_thread(chunks),
             media_type="application/x-ndjson",
-            headers={
-                "X-Content-Type-Options": "nosniff",
-                "Cache-Control": "no-cache"
-            }
+            headers=headers
         )
 
     except Exception as e:
-        # Ensure cleanup on any error
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
-        
         # Clear caches and force garbage collection
         clear_quantity_caches()
-        clear_property_caches()
         gc.collect()
         
+        if isinstance(e, HTTPException):
+            raise
         raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
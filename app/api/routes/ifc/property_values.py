@@ -1,17 +1,24 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Query
-import tempfile
-import os
+from fastapi.responses import ORJSONResponse
+import asyncio
 import logging
-import ifcopenshell
-from app.core.models.property_values import PropertyValue, PropertyValuesResponse
+from app.core.models.property_values import PropertyValuesResponse
 from app.services.ifc.property_values import get_property_values
+from app.services.ifc.cache import ifc_file_cache
+from .common import spool_upload
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
+def _read_property_values(temp_path: str, file_hash: str, ifc_class: str, property_path: str):
+    """Parse the upload through the IFC file cache and read the property values."""
+    ifc_file = ifc_file_cache.open(file_hash, temp_path)["ifc"]
+    return get_property_values(ifc_file, ifc_class, property_path)
+
 @router.post("/property-values", 
     response_model=PropertyValuesResponse,
+    response_class=ORJSONResponse,
     summary="Extract Property Values by IFC Class",
     description="""
     Extracts specific property values for all elements of a given IFC class.
@@ -57,7 +64,7 @@ async def get_property_values_for_class(
         ..., 
         description="Property path in format 'PsetName.PropertyName'. Supports wildcards in PsetName (e.g., '*Common.LoadBearing')"
     )
-) -> PropertyValuesResponse:
+) -> ORJSONResponse:
     """
     Get property values for all elements of a specific IFC class.
     
@@ -70,36 +77,19 @@ async def get_property_values_for_class(
     if not file.filename.endswith('.ifc'):
         raise HTTPException(status_code=400, detail="Invalid file type. Must be an IFC file.")
 
-    # Save uploaded file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.ifc') as temp_file:
-        content = await file.read()
-        temp_file.write(content)
-        temp_path = temp_file.name
-
     try:
-        ifc_file = ifcopenshell.open(temp_path)
-        
-        # Get property values using the service function
-        values = get_property_values(ifc_file, ifc_class, property_path)
+        # Copied to disk in chunks; parsing and the lookup run on a worker thread
+        async with spool_upload(file) as (temp_path, file_hash):
+            values = await asyncio.to_thread(_read_property_values, temp_path, file_hash, ifc_class, property_path)
         
-        # Convert to response model
-        return PropertyValuesResponse(
-            values=[
-                PropertyValue(
-                    guid=value.guid,
-                    value=value.value,
-                    data_type=value.data_type
-                ) for value in values
-            ],
-            total_elements=len(values)
-        )
+        # The service's PropertyValue dataclasses are serialized by orjson directly,
+        # without building and validating a Pydantic model per value
+        return ORJSONResponse({"values": values, "total_elements": len(values)})
 
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error processing property values: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        # Cleanup
-        if os.path.exists(temp_path):
-            os.unlink(temp_path)
\ No newline at end of file
@@ -1,16 +1,101 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
-import tempfile
+from fastapi import APIRouter, UploadFile, File, HTTPException, Query
+from fastapi.responses import FileResponse, StreamingResponse
+from typing import Dict, List, Literal, Optional, Set, Tuple
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import os
 import logging
-import ifcopenshell
+import asyncio
+import multiprocessing
+import sys
+import threading
+import uuid
 import zipfile
 import shutil
-from app.services.ifc.splitter import StoreySpiltterService
+from app.core.config import settings
+from app.services.ifc.splitter import split_file_by_storey
+from app.services.ifc.archive import fits_zip32, iter_zip_files, write_zip
+from .common import spool_upload, check_ifc_header, copy_upload, make_upload_tempfile, remove_file
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Splits run in a worker process that exits after each split (Python 3.11+),
+# so the memory of a parsed model never stays with the web process
+SPLIT_WORKERS = 1
+_split_pool: Optional[ProcessPoolExecutor] = None
+_split_pool_lock = threading.Lock()
+
+def _get_split_pool() -> ProcessPoolExecutor:
+    """Get the split worker pool, creating it on first use."""
+    global _split_pool
+    with _split_pool_lock:
+        if _split_pool is None:
+            options = {"max_tasks_per_child": 1} if sys.version_info >= (3, 11) else {}
+            _split_pool = ProcessPoolExecutor(
+                max_workers=SPLIT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                **options
+            )
+        return _split_pool
+
+def _discard_split_pool():
+    """Drop a broken split pool so the next request starts a new one."""
+    global _split_pool
+    with _split_pool_lock:
+        if _split_pool is not None:
+            _split_pool.shutdown(wait=False, cancel_futures=True)
+            _split_pool = None
+
+def shutdown_split_pool():
+    """Stop the split worker process, if one was started."""
+    global _split_pool
+    with _split_pool_lock:
+        if _split_pool is not None:
+            _split_pool.shutdown(cancel_futures=True)
+            _split_pool = None
+
+# IFC is plain text that deflates to a fraction of its size, so the archive is
+# compressed by default; level 6 is zlib's usual balance of size and speed
+ZIP_COMPRESSION = {
+    "deflate": zipfile.ZIP_DEFLATED,
+    "lzma": zipfile.ZIP_LZMA,
+    "stored": zipfile.ZIP_STORED,
+}
+ZIP_COMPRESSLEVEL = 6
+
+async def _split_file(file_path: str) -> Tuple[List[Dict[str, str]], str]:
+    """Split an IFC file by storey, returning (result_files, output_dir).
+
+    Parsing and splitting run in a worker process, so the model's memory is
+    returned to the OS afterwards and a crash or OOM in ifcopenshell cannot
+    take the web worker down.
+    """
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            _get_split_pool(), split_file_by_storey, file_path
+        )
+    except BrokenProcessPool:
+        _discard_split_pool()
+        raise HTTPException(
+            status_code=500,
+            detail="Splitting the IFC file failed; the file may be too large to process"
+        )
+
+async def _remove_output_dir(output_dir: Optional[str]):
+    """Delete a split's output directory on a worker thread.
+
+    A directory of storey files can take long enough to delete that doing
+    it on the event loop would hold up other requests.
+    """
+    if not output_dir:
+        return
+    try:
+        await asyncio.to_thread(shutil.rmtree, output_dir, ignore_errors=True)
+    except Exception as e:
+        logger.error(f"Error during cleanup: {str(e)}")
+
 @router.post("/split-by-storey",
     summary="Split IFC by Building Storeys",
     description="""
@@ -52,47 +137,47 @@ logger = logging.getLogger(__name__)
     This means some entities (like IfcProject) are duplicated across files to maintain
     proper IFC structure and relationships.
     """)
-async def split_by_storey(file: UploadFile = File(...)):
+async def split_by_storey(
+    file: UploadFile = File(...),
+    compression: Literal["deflate", "lzma", "stored"] = Query(
+        default="deflate",
+        description="Compression of the files in the zip: 'deflate' (default), 'lzma' for the smallest archive, or 'stored' for none"
+    )
+):
     """Split an IFC file by storey and return as zip"""
     if not file.filename.endswith('.ifc'):
         raise HTTPException(status_code=400, detail="Invalid file type. Must be an IFC file.")
 
-    tmp_file_path = None
     output_dir = None
     try:
-        # Save uploaded file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.ifc') as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_file.flush()
-            tmp_file_path = tmp_file.name
-        
-        # Process the file
-        ifc_file = ifcopenshell.open(tmp_file_path)
-        splitter = StoreySpiltterService(ifc_file)
-        result_files, output_dir = splitter.split_by_storey()
+        # Save uploaded file in 1MB chunks instead of reading it into memory;
+        # the upload is removed once it has been split
+        async with spool_upload(file) as (tmp_file_path, _):
+            result_files, output_dir = await _split_file(tmp_file_path)
         
         if not result_files:
             raise HTTPException(status_code=400, detail="No storeys found in the IFC file")
         
-        # Create zip file
-        zip_path = os.path.join(output_dir, "storeys.zip")
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file_info in result_files:
-                zipf.write(
-                    file_info["file_path"], 
-                    arcname=file_info["file_name"]
-                )
+        storey_files = [(file_info["file_path"], file_info["file_name"]) for file_info in result_files]
 
         async def cleanup_background():
             """Clean up files after response is sent"""
-            try:
-                if tmp_file_path and os.path.exists(tmp_file_path):
-                    os.unlink(tmp_file_path)
-                if output_dir and os.path.exists(output_dir):
-                    shutil.rmtree(output_dir)
-            except Exception as e:
-                logger.error(f"Error during cleanup: {str(e)}")
+            await _remove_output_dir(output_dir)
+
+        if compression in ("deflate", "stored") and fits_zip32(storey_files):
+            # Stream the archive while the storeys are deflated (or checksummed)
+            # in parallel, so the download starts once the first storey is done
+            # and each storey is read from disk only once
+            return StreamingResponse(
+                iter_zip_files(storey_files, level=ZIP_COMPRESSLEVEL, compression=ZIP_COMPRESSION[compression]),
+                media_type='application/zip',
+                headers={"Content-Disposition": 'attachment; filename="storeys.zip"'},
+                background=cleanup_background
+            )
+
+        # Create zip file
+        zip_path = os.path.join(output_dir, "storeys.zip")
+        await asyncio.to_thread(write_zip, zip_path, storey_files, ZIP_COMPRESSION[compression], ZIP_COMPRESSLEVEL)
 
         return FileResponse(
             zip_path,
@@ -100,11 +185,161 @@ async def split_by_storey(file: UploadFile = File(...)):
             filename='storeys.zip',
             background=cleanup_background
         )
-        
+
+    except HTTPException:
+        await _remove_output_dir(output_dir)
+        raise
     except Exception as e:
         # Clean up on error
-        if tmp_file_path and os.path.exists(tmp_file_path):
-            os.unlink(tmp_file_path)
-        if output_dir and os.path.exists(output_dir):
-            shutil.rmtree(output_dir)
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        await _remove_output_dir(output_dir)
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Background split jobs for files that take longer to split than a proxy
+# keeps a request open. Jobs live in this process (the service runs a single
+# worker) and are dropped, with their files, SPLIT_JOB_TTL seconds after they
+# finished.
+SPLIT_JOB_TTL = 60 * 60
+MAX_ACTIVE_SPLIT_JOBS = 8
+
+@dataclass
+class SplitJob:
+    """State of a split running in the background."""
+    job_id: str
+    status: str = "queued"
+    output_dir: Optional[str] = None
+    zip_path: Optional[str] = None
+    error: Optional[str] = None
+
+_split_jobs: Dict[str, SplitJob] = {}
+# Running job tasks, referenced so they are not garbage collected mid-run
+_split_job_tasks: Set[asyncio.Task] = set()
+
+def _start_split_task(coro) -> asyncio.Task:
+    """Run a job coroutine as a task that is kept referenced until it is done."""
+    task = asyncio.create_task(coro)
+    _split_job_tasks.add(task)
+    task.add_done_callback(_split_job_tasks.discard)
+    return task
+
+async def _run_split_job(job: SplitJob, file_path: str, compression: str):
+    """Split an uploaded file and write its zip archive, recording the outcome on job.
+
+    Once the job is done, its expiry is scheduled on the event loop, so its
+    files are removed even if no other job is ever started.
+    """
+    job.status = "processing"
+    try:
+        result_files, job.output_dir = await _split_file(file_path)
+        if not result_files:
+            raise ValueError("No storeys found in the IFC file")
+
+        storey_files = [(file_info["file_path"], file_info["file_name"]) for file_info in result_files]
+        zip_path = os.path.join(job.output_dir, "storeys.zip")
+        await asyncio.to_thread(write_zip, zip_path, storey_files, ZIP_COMPRESSION[compression], ZIP_COMPRESSLEVEL)
+        job.zip_path = zip_path
+        job.status = "complete"
+    except Exception as e:
+        logger.error(f"Split job {job.job_id} failed: {str(e)}")
+        job.status = "failed"
+        job.error = e.detail if isinstance(e, HTTPException) else str(e)
+        await _remove_output_dir(job.output_dir)
+        job.output_dir = None
+    finally:
+        await asyncio.to_thread(remove_file, file_path)
+        asyncio.get_running_loop().call_later(
+            SPLIT_JOB_TTL, lambda: _start_split_task(_expire_split_job(job))
+        )
+
+async def _expire_split_job(job: SplitJob):
+    """Drop a finished job and delete its files."""
+    _split_jobs.pop(job.job_id, None)
+    await _remove_output_dir(job.output_dir)
+
+def _get_split_job(job_id: str) -> SplitJob:
+    job = _split_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown split job")
+    return job
+
+def _job_status(job: SplitJob) -> Dict[str, str]:
+    status = {"job_id": job.job_id, "status": job.status}
+    if job.error:
+        status["error"] = job.error
+    return status
+
+@router.post("/split-by-storey/jobs",
+    status_code=202,
+    summary="Start Splitting an IFC File by Building Storeys",
+    description="""
+    Starts splitting an IFC file by building storey in the background and returns at once
+    with a job id, for files that take longer to split than a client or proxy keeps a request open.
+
+    Poll `GET /split-by-storey/jobs/{job_id}` until the status is `complete` (or `failed`),
+    then download the zip archive from `GET /split-by-storey/jobs/{job_id}/result`.
+    Finished jobs and their archives are removed an hour after they finish.
+
+    Example Response (202 Accepted):
+    ```json
+    {"job_id": "3f2b9c0e8a1d4f6b9e7c5a2d1b0f8e6c", "status": "queued"}
+    ```
+    """)
+async def create_split_job(
+    file: UploadFile = File(...),
+    compression: Literal["deflate", "lzma", "stored"] = Query(
+        default="deflate",
+        description="Compression of the files in the zip: 'deflate' (default), 'lzma' for the smallest archive, or 'stored' for none"
+    )
+):
+    """Queue a split of an IFC file by storey"""
+    if not file.filename.endswith('.ifc'):
+        raise HTTPException(status_code=400, detail="Invalid file type. Must be an IFC file.")
+
+    if sum(job.status in ("queued", "processing") for job in _split_jobs.values()) >= MAX_ACTIVE_SPLIT_JOBS:
+        raise HTTPException(status_code=503, detail="Too many split jobs running. Try again later.")
+
+    # The upload has to outlive this request, so it is copied to a temp file
+    # that the job removes once the file is split
+    check_ifc_header(file.file)
+    tmp_file_path = await asyncio.to_thread(make_upload_tempfile)
+    try:
+        await asyncio.to_thread(copy_upload, file.file, tmp_file_path, settings.MAX_UPLOAD_SIZE)
+    except BaseException:
+        await asyncio.to_thread(remove_file, tmp_file_path)
+        raise
+
+    job = SplitJob(job_id=uuid.uuid4().hex)
+    _split_jobs[job.job_id] = job
+    _start_split_task(_run_split_job(job, tmp_file_path, compression))
+
+    return _job_status(job)
+
+@router.get("/split-by-storey/jobs/{job_id}",
+    summary="Get the Status of a Split Job",
+    description="""
+    Returns the status of a split job: `queued`, `processing`, `complete` or `failed`.
+    Failed jobs include an `error` message.
+    """)
+async def get_split_job(job_id: str):
+    """Get the status of a split job"""
+    return _job_status(_get_split_job(job_id))
+
+@router.get("/split-by-storey/jobs/{job_id}/result",
+    summary="Download the Result of a Split Job",
+    description="""
+    Returns the zip archive of a completed split job. Responds with 409 while the job
+    is still running or if it failed.
+    """)
+async def get_split_job_result(job_id: str):
+    """Download the zip archive of a completed split job"""
+    job = _get_split_job(job_id)
+    if job.status != "complete":
+        raise HTTPException(
+            status_code=409,
+            detail=job.error if job.status == "failed" else f"Split job is {job.status}"
+        )
+
+    return FileResponse(
+        job.zip_path,
+        media_type='application/zip',
+        filename='storeys.zip'
+    )
@@ -8,6 +8,8 @@ class Settings(BaseSettings):
     # Add any additional configuration settings here
     MAX_UPLOAD_SIZE: int = 100 * 1024 * 1024  # 100MB
     ALLOWED_FILE_TYPES: Set[str] = {".ifc"}
+    # Directory for upload temp files; empty picks /dev/shm when it can hold an upload
+    UPLOAD_TMPDIR: str = ""
     
     # API Key settings
     API_KEY: str  # Single key for tests
@@ -1,25 +1,46 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.routes import router
 from .middleware.api_key import api_key_middleware
 from .core import analytics
 from .services.cleanup import TempFileCleanupService
+from .api.routes.ifc.extract_elements import (
+    start_extract_pool,
+    shutdown_extract_pool,
+    get_callback_client,
+    close_callback_client
+)
+from .api.routes.ifc.split_by_storey import shutdown_split_pool
+from .api.routes.ifc.common import UPLOAD_TMPDIR
 import asyncio
+import tempfile
 
+# Routes that return plain dicts or models are serialized with orjson
 app = FastAPI(
+    default_response_class=ORJSONResponse,
     title="IFC Service API",
     description="REST API for processing IFC files",
     version="0.0.2",
     openapi_version="3.1.0"
 )
 
-# Initialize cleanup service
-cleanup_service = TempFileCleanupService(max_file_age_hours=24)
+# Initialize cleanup service; uploads may be spooled outside the system temp dir
+cleanup_service = TempFileCleanupService(
+    max_file_age_hours=24,
+    temp_dirs=[tempfile.gettempdir()] + ([UPLOAD_TMPDIR] if UPLOAD_TMPDIR else [])
+)
 
 @app.on_event("startup")
 async def startup_event():
     # Start cleanup service
     asyncio.create_task(cleanup_service.start())
+
+    # Create the pooled client for extraction callbacks
+    get_callback_client()
+
+    # Start extraction worker processes ahead of the first large request
+    start_extract_pool()
     
     # Initialize analytics
     print("Initializing analytics...")
@@ -33,6 +54,13 @@ async def shutdown_event():
     # Stop cleanup service
     await cleanup_service.stop()
 
+    # Stop extraction and split worker processes
+    shutdown_extract_pool()
+    shutdown_split_pool()
+
+    # Close pooled callback connections
+    await close_callback_client()
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -7,6 +7,9 @@ from starlette.status import HTTP_401_UNAUTHORIZED
 from ..core.analytics import capture_event
 import uuid
 import sys
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
@@ -21,6 +24,18 @@ if isinstance(API_USER_KEYS, str):
     except json.JSONDecodeError:
         API_USER_KEYS = []
 
+# Analytics events are sent from their own thread, so a slow PostHog never
+# holds up requests or the default executor that uploads are copied on
+_analytics_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analytics")
+
+def _log_analytics_failure(future: asyncio.Future):
+    """Log an analytics event that failed on the analytics thread."""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Failed to capture analytics: {error}", exc_info=error)
+
 def is_swagger_request(request: Request, referer: str) -> bool:
     """Determine if request is coming from Swagger UI"""
     swagger_paths = [
@@ -81,15 +96,19 @@ async def api_key_middleware(request: Request, call_next):
     }
     
     try:
-        # Use capture_event directly instead of capture_pageview since we want a custom event name
-        capture_event(
+        # Use capture_event directly instead of capture_pageview since we want a custom event name.
+        # It flushes to PostHog over the network, so it runs on the analytics
+        # thread without the request waiting for it; failures are logged when it is done
+        future = asyncio.get_running_loop().run_in_executor(_analytics_executor, functools.partial(
+            capture_event,
             distinct_id=distinct_id,
             event_name='api_request',
             properties={
                 '$current_url': str(request.url),
                 **properties  # Include all our custom properties
             }
-        )
+        ))
+        future.add_done_callback(_log_analytics_failure)
     except Exception as e:
         logger.error(f"Failed to capture analytics: {e}", exc_info=True)
     
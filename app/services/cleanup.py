@@ -3,12 +3,15 @@ import asyncio
 import logging
 import tempfile
 from datetime import datetime, timedelta
+from typing import List, Optional
 
 logger = logging.getLogger(__name__)
 
 class TempFileCleanupService:
-    def __init__(self, max_file_age_hours: int = 24):
+    def __init__(self, max_file_age_hours: int = 24, temp_dirs: Optional[List[str]] = None):
         self.max_file_age = timedelta(hours=max_file_age_hours)
+        # Directories scanned for stale uploads; the system temp dir by default
+        self.temp_dirs = list(dict.fromkeys(temp_dirs or [tempfile.gettempdir()]))
         self.is_running = False
         self.cleanup_interval = timedelta(hours=1)  # Run cleanup every hour
         
@@ -33,7 +36,12 @@ class TempFileCleanupService:
     
     async def cleanup_temp_files(self):
         """Clean up temporary files older than max_file_age"""
-        temp_dir = tempfile.gettempdir()
+        # Listing and deleting files blocks, so the scan runs on a worker thread
+        for temp_dir in self.temp_dirs:
+            await asyncio.to_thread(self._cleanup_dir, temp_dir)
+
+    def _cleanup_dir(self, temp_dir: str):
+        """Remove .ifc files older than max_file_age from temp_dir."""
         current_time = datetime.now()
         files_removed = 0
         
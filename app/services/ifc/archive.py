@@ -0,0 +1,231 @@
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import os
+import struct
+import time
+import zipfile
+import zlib
+
+# Zip archives of split IFC files. Members are deflated in parallel, each into
+# its own raw deflate file, and the archive is then assembled from those
+# without compressing anything again. zlib releases the GIL while it
+# compresses, so a thread pool keeps every core busy. Stored (uncompressed)
+# members only have their CRC computed up front and are copied as they are.
+
+DEFLATE_CHUNK_SIZE = 1024 * 1024
+
+# Largest size or offset a zip without ZIP64 extensions can describe
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+# UTF-8 file name flag (general purpose bit 11)
+_UTF8_FLAG = 0x800
+
+@dataclass(frozen=True)
+class DeflatedMember:
+    """A file prepared for a zip archive, whose member data is in deflated_path.
+
+    For deflated members that is a raw deflate file made for the archive; for
+    stored members it is the file itself.
+    """
+    arcname: str
+    deflated_path: str
+    crc: int
+    compress_size: int
+    file_size: int
+    date_time: Tuple[int, int, int, int, int, int]
+    compress_type: int = zipfile.ZIP_DEFLATED
+
+def deflate_file(path: str, arcname: str, level: int = 6) -> DeflatedMember:
+    """Deflate path into a raw deflate file next to it, computing its CRC on the way."""
+    deflated_path = path + ".deflate"
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    file_size = 0
+    with open(path, "rb") as src, open(deflated_path, "wb") as dst:
+        while chunk := src.read(DEFLATE_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            dst.write(compressor.compress(chunk))
+        dst.write(compressor.flush())
+        compress_size = dst.tell()
+    return DeflatedMember(
+        arcname=arcname,
+        deflated_path=deflated_path,
+        crc=crc,
+        compress_size=compress_size,
+        file_size=file_size,
+        date_time=time.localtime(os.path.getmtime(path))[:6]
+    )
+
+def store_file(path: str, arcname: str, level: int = 0) -> DeflatedMember:
+    """Prepare path as a stored member by computing its CRC; level is ignored."""
+    crc = 0
+    with open(path, "rb") as src:
+        while chunk := src.read(DEFLATE_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+        file_size = src.tell()
+    return DeflatedMember(
+        arcname=arcname,
+        deflated_path=path,
+        crc=crc,
+        compress_size=file_size,
+        file_size=file_size,
+        date_time=time.localtime(os.path.getmtime(path))[:6],
+        compress_type=zipfile.ZIP_STORED
+    )
+
+def _dos_date_time(date_time: Tuple[int, int, int, int, int, int]) -> Tuple[int, int]:
+    """Pack a (year, month, day, hour, minute, second) tuple into DOS date and time fields."""
+    year, month, day, hour, minute, second = date_time
+    year = max(year, 1980)
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+def _local_header(member: DeflatedMember, name: bytes, flags: int) -> bytes:
+    dos_date, dos_time = _dos_date_time(member.date_time)
+    return struct.pack(
+        "<IHHHHHIIIHH", 0x04034B50, 20, flags, member.compress_type, dos_time, dos_date,
+        member.crc, member.compress_size, member.file_size, len(name), 0
+    ) + name
+
+def _central_header(member: DeflatedMember, name: bytes, flags: int, offset: int) -> bytes:
+    dos_date, dos_time = _dos_date_time(member.date_time)
+    return struct.pack(
+        "<IHHHHHHIIIHHHHHII", 0x02014B50, 3 << 8 | 20, 20, flags, member.compress_type, dos_time, dos_date,
+        member.crc, member.compress_size, member.file_size, len(name), 0, 0, 0, 0, 0o100644 << 16, offset
+    ) + name
+
+def _encode_name(arcname: str) -> Tuple[bytes, int]:
+    try:
+        return arcname.encode("ascii"), 0
+    except UnicodeEncodeError:
+        return arcname.encode("utf-8"), _UTF8_FLAG
+
+def _iter_archive(members: Iterable[DeflatedMember]) -> Iterator[bytes]:
+    """Yield the bytes of a zip archive of prepared members, copying their data as is.
+
+    Each member's deflate file is removed once it has been copied; the files
+    of stored members are left in place.
+    """
+    central_directory = []
+    offset = 0
+    for member in members:
+        name, flags = _encode_name(member.arcname)
+        central_directory.append(_central_header(member, name, flags, offset))
+        local_header = _local_header(member, name, flags)
+        yield local_header
+        with open(member.deflated_path, "rb") as deflated:
+            while chunk := deflated.read(DEFLATE_CHUNK_SIZE):
+                yield chunk
+        if member.compress_type == zipfile.ZIP_DEFLATED:
+            os.unlink(member.deflated_path)
+        offset += len(local_header) + member.compress_size
+
+    directory = b"".join(central_directory)
+    yield directory
+    yield struct.pack(
+        "<IHHHHIIH", 0x06054B50, 0, 0, len(central_directory), len(central_directory), len(directory), offset, 0
+    )
+
+def fits_zip32(files: Sequence[Tuple[str, str]]) -> bool:
+    """Whether deflating (path, arcname) files stays within the limits of a zip without ZIP64.
+
+    Uses zlib's worst-case deflate size, so it can be decided before compressing.
+    """
+    total = 0
+    for path, arcname in files:
+        size = os.path.getsize(path)
+        if size >= _ZIP32_LIMIT:
+            return False
+        compress_bound = size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+        total += compress_bound + 76 + 2 * len(arcname.encode("utf-8"))
+    return len(files) < 0xFFFF and total < _ZIP32_LIMIT
+
+_PREPARE_MEMBER = {
+    zipfile.ZIP_DEFLATED: deflate_file,
+    zipfile.ZIP_STORED: store_file
+}
+
+def _deflate_all(
+    executor: ThreadPoolExecutor,
+    files: Sequence[Tuple[str, str]],
+    level: int,
+    compression: int = zipfile.ZIP_DEFLATED
+) -> Iterator[DeflatedMember]:
+    """Prepare files on the executor, yielding each member in order as soon as it is done."""
+    prepare = _PREPARE_MEMBER[compression]
+    futures = [executor.submit(prepare, path, arcname, level) for path, arcname in files]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+def _remove_deflated(files: Sequence[Tuple[str, str]]):
+    for path, _ in files:
+        try:
+            os.unlink(path + ".deflate")
+        except FileNotFoundError:
+            pass
+
+def iter_zip_files(
+    files: Sequence[Tuple[str, str]],
+    level: int = 6,
+    max_workers: Optional[int] = None,
+    compression: int = zipfile.ZIP_DEFLATED
+) -> Iterator[bytes]:
+    """Yield a zip archive of (path, arcname) files while it is being built.
+
+    Members are compressed (ZIP_DEFLATED) or checksummed (ZIP_STORED) in
+    parallel and sent in order as each one is ready, so the first bytes go
+    out once the first file is done. The archive must fit a plain zip (see
+    fits_zip32).
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1)
+    try:
+        yield from _iter_archive(_deflate_all(executor, files, level, compression))
+    finally:
+        executor.shutdown(wait=True)
+        _remove_deflated(files)
+
+def zip_files(
+    zip_path: str,
+    files: Sequence[Tuple[str, str]],
+    level: int = 6,
+    max_workers: Optional[int] = None
+):
+    """Write (path, arcname) files into a deflated zip archive, compressing them in parallel.
+
+    Archives too large for a plain zip are written with zipfile instead, which
+    adds the ZIP64 extensions they need.
+    """
+    if not fits_zip32(files):
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=level) as zipf:
+            for path, arcname in files:
+                zipf.write(path, arcname=arcname)
+        return
+
+    with open(zip_path, "wb") as zip_file:
+        for chunk in iter_zip_files(files, level, max_workers):
+            zip_file.write(chunk)
+
+def write_zip(
+    zip_path: str,
+    files: Sequence[Tuple[str, str]],
+    compression: int = zipfile.ZIP_DEFLATED,
+    level: int = 6,
+    max_workers: Optional[int] = None
+):
+    """Write (path, arcname) files into a zip archive with a zipfile compression constant.
+
+    Deflated archives are compressed in parallel (see zip_files); other
+    compressions are written with zipfile.
+    """
+    if compression == zipfile.ZIP_DEFLATED:
+        zip_files(zip_path, files, level, max_workers)
+        return
+
+    with zipfile.ZipFile(zip_path, "w", compression=compression, compresslevel=level) as zipf:
+        for path, arcname in files:
+            zipf.write(path, arcname=arcname)
@@ -0,0 +1,138 @@
+from typing import Dict, Any, List, Optional, Callable, Tuple
+from collections import OrderedDict, defaultdict
+import threading
+import logging
+import ifcopenshell
+from app.services.ifc.units import get_project_units
+from app.services.lca.materials import MaterialService
+from app.services.ifc.index import PropertyIndex
+
+logger = logging.getLogger(__name__)
+
+# Number of parsed models kept in memory
+MAX_CACHED_MODELS = 4
+
+class IfcFileCache:
+    """LRU cache of parsed IFC files keyed by the content hash of the upload.
+
+    Paging through a model re-sends the same file, so the expensive
+    ifcopenshell.open is only paid once per distinct upload.
+    """
+
+    def __init__(self, maxsize: int = MAX_CACHED_MODELS):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Get a cached model entry and mark it as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def open(self, key: str, file_path: Optional[str] = None, content: Optional[str] = None) -> Dict[str, Any]:
+        """Get the cached entry for key, parsing content or file_path on a miss."""
+        entry = self.get(key)
+        if entry is not None:
+            logger.debug(f"IFC cache hit for {key}")
+            return entry
+
+        if file_path is None and content is None:
+            raise KeyError(f"No cached IFC file for key {key}")
+
+        # Parse outside the lock so other models stay available meanwhile
+        if content is not None:
+            ifc_file = ifcopenshell.file.from_string(content)
+        else:
+            ifc_file = ifcopenshell.open(file_path)
+        entry = {
+            "ifc": ifc_file,
+            "units": get_project_units(ifc_file),
+            "material_service": None,
+            "property_index": None,
+            "by_type_cache": {},
+            "class_index": {},
+            "element_memo": {}
+        }
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def clear(self):
+        """Drop all cached models."""
+        with self._lock:
+            self._entries.clear()
+
+def cached_by_type(entry: Dict[str, Any], class_name: str):
+    """ifc_file.by_type memoized on a cache entry."""
+    by_type_cache = entry["by_type_cache"]
+    elements = by_type_cache.get(class_name)
+    if elements is None:
+        elements = entry["ifc"].by_type(class_name)
+        by_type_cache[class_name] = elements
+    return elements
+
+def material_service_for(entry: Dict[str, Any]) -> MaterialService:
+    """The entry's MaterialService, created the first time materials are requested."""
+    material_service = entry["material_service"]
+    if material_service is None:
+        material_service = entry["material_service"] = MaterialService(entry["ifc"])
+    return material_service
+
+def property_index_for(entry: Dict[str, Any]) -> PropertyIndex:
+    """The entry's PropertyIndex, built the first time quantities are looked up."""
+    property_index = entry["property_index"]
+    if property_index is None:
+        property_index = entry["property_index"] = PropertyIndex(entry["ifc"])
+    return property_index
+
+def classified_elements(entry: Dict[str, Any], base_class: str) -> List[Tuple[Any, str]]:
+    """(element, exact class) pairs for base_class in by_type order, classified once per entry."""
+    key = ("classified", base_class)
+    pairs = entry["class_index"].get(key)
+    if pairs is None:
+        pairs = entry["class_index"][key] = [
+            (element, element.is_a()) for element in cached_by_type(entry, base_class)
+        ]
+    return pairs
+
+def elements_by_class(entry: Dict[str, Any], base_class: str) -> Dict[str, List[Tuple[Any, str]]]:
+    """Index the (element, class) pairs of base_class by their exact class, built once per entry."""
+    class_index = entry["class_index"].get(base_class)
+    if class_index is None:
+        class_index = defaultdict(list)
+        for pair in classified_elements(entry, base_class):
+            class_index[pair[1]].append(pair)
+        class_index = entry["class_index"][base_class] = dict(class_index)
+    return class_index
+
+def element_memo(entry: Dict[str, Any], name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap a per-element extractor so its result is memoized by element id on a cache entry.
+
+    Extra arguments are passed through on a miss but are not part of the key,
+    so they must be derived from the element itself (such as its class).
+    """
+    results = entry["element_memo"].setdefault(name, {})
+
+    def memoized(element, *args):
+        element_id = element.id()
+        try:
+            return results[element_id]
+        except KeyError:
+            value = results[element_id] = func(element, *args)
+            return value
+
+    return memoized
+
+ifc_file_cache = IfcFileCache()
@@ -1,3 +1,5 @@
+from .quantities import PROPERTY_DEFINITION_RELS
+
 def compute_constituent_fractions(model, constituent_set, associated_elements, unit_scale_to_mm):
     """
     Computes fractions for each material constituent based on their widths. Uses width as a fallback.
@@ -13,24 +15,37 @@ def compute_constituent_fractions(model, constituent_set, associated_elements, u
       - fractions: Dictionary mapping each constituent to its fraction
       - widths: Dictionary mapping each constituent to its width in mm
     """
+    # Collect the element quantity sets of the elements
+    element_quantities = []
+    for element in associated_elements:
+        for rel in getattr(element, 'IsDefinedBy', []):
+            if rel.is_a() in PROPERTY_DEFINITION_RELS:
+                prop_def = rel.RelatingPropertyDefinition
+                if prop_def.is_a() == 'IfcElementQuantity':
+                    element_quantities.append(prop_def)
+
+    return constituent_fractions_from_quantities(constituent_set, element_quantities, unit_scale_to_mm)
+
+def constituent_fractions_from_quantities(constituent_set, element_quantities, unit_scale_to_mm):
+    """
+    Computes the fractions and widths of compute_constituent_fractions from given IfcElementQuantity sets.
+
+    The result depends only on the constituent set and these quantity sets,
+    so callers can memoize it on their ids.
+    """
     fractions = {}
     constituents = constituent_set.MaterialConstituents or []
     if not constituents:
         return fractions, {}  # No constituents to process
 
-    # Collect quantities associated with the elements
     quantities = []
-    for element in associated_elements:
-        for rel in getattr(element, 'IsDefinedBy', []):
-            if rel.is_a('IfcRelDefinesByProperties'):
-                prop_def = rel.RelatingPropertyDefinition
-                if prop_def.is_a('IfcElementQuantity'):
-                    quantities.extend(prop_def.Quantities)
+    for element_quantity in element_quantities:
+        quantities.extend(element_quantity.Quantities)
 
     # Build a mapping of quantity names to quantities
     quantity_name_map = {}
     for q in quantities:
-        if q.is_a('IfcPhysicalComplexQuantity'):
+        if q.is_a() == 'IfcPhysicalComplexQuantity':
             q_name = (q.Name or '').strip().lower()
             quantity_name_map.setdefault(q_name, []).append(q)
 
@@ -51,7 +66,7 @@ def compute_constituent_fractions(model, constituent_set, associated_elements, u
             matched_quantity = quantities_with_name[count]
             # Extract 'Width' sub-quantity
             for sub_q in getattr(matched_quantity, 'HasQuantities', []):
-                if sub_q.is_a('IfcQuantityLength') and (sub_q.Name or '').strip().lower() == 'width':
+                if sub_q.is_a() == 'IfcQuantityLength' and (sub_q.Name or '').strip().lower() == 'width':
                     raw_length_value = getattr(sub_q, 'LengthValue', 0.0)
                     width_mm = raw_length_value * unit_scale_to_mm
                     break
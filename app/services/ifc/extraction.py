@@ -0,0 +1,282 @@
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass
+import functools
+import threading
+import numpy as np
+from app.services.ifc.properties import get_common_properties, get_object_type
+from app.services.ifc.quantities import (
+    get_volume_from_properties,
+    get_area_from_properties,
+    get_dimensions_from_properties
+)
+from app.services.ifc.units import get_unit_factor
+from app.services.ifc.cache import ifc_file_cache, element_memo, material_service_for, property_index_for
+from app.services.ifc.constituents import constituent_fractions_from_quantities
+
+# Per-element extraction for extract-building-elements. Kept free of web
+# framework imports so worker processes load little and the fully annotated
+# hot path can be compiled (e.g. with mypyc) on its own.
+
+class BatchRounder:
+    """Defers rounding of float values so a whole page is rounded with NumPy in one pass.
+
+    Values are written into their target dict unrounded by set() and replaced
+    with the rounded value on flush(). Anything that is not a float (None,
+    ints, strings) is stored as-is, matching _round_value.
+    """
+
+    def __init__(self) -> None:
+        self._targets: List[Tuple[Dict[str, Any], str]] = []
+        self._values: List[float] = []
+        self._digits: List[int] = []
+
+    def set(self, target: Dict[str, Any], key: str, value: Any, digits: int = 3) -> None:
+        target[key] = value
+        if isinstance(value, float):
+            self._targets.append((target, key))
+            self._values.append(value)
+            self._digits.append(digits)
+
+    def flush(self) -> None:
+        """Round all collected values and write them back into their dicts."""
+        if not self._values:
+            return
+        values = np.fromiter(self._values, dtype=np.float64, count=len(self._values))
+        digits = np.fromiter(self._digits, dtype=np.int64, count=len(self._digits))
+        for precision in np.unique(digits):
+            mask = digits == precision
+            values[mask] = np.round(values[mask], int(precision))
+        for (target, key), value in zip(self._targets, values.tolist()):
+            target[key] = value
+        self._targets.clear()
+        self._values.clear()
+        self._digits.clear()
+
+@dataclass(frozen=True)
+class ExtractOptions:
+    """Which parts of the element data to leave out."""
+    exclude_properties: bool = False
+    exclude_quantities: bool = False
+    exclude_materials: bool = False
+    exclude_width: bool = False
+    exclude_constituent_volumes: bool = False
+
+class ElementExtractor:
+    """Builds the response dict of a building element for one cached model.
+
+    Per-element extractors are memoized on the model's cache entry so repeated
+    page requests reuse them. Quantities are rounded by the given BatchRounder,
+    which the caller flushes once all elements are built.
+    """
+
+    def __init__(self, model: Dict[str, Any], options: ExtractOptions, rounder: BatchRounder) -> None:
+        self.ifc_file: Any = model["ifc"]
+        self.length_unit: Dict[str, Any] = model["units"].get("LENGTHUNIT", {"type": "LENGTHUNIT", "name": "METER"})
+        # Resolved once per model instead of per converted value
+        self.unit_factor: float = get_unit_factor(self.length_unit)
+        self.unit_scale_mm: float = float(self.length_unit.get("scale_to_mm", 1.0))
+        self.options = options
+        self.rounder = rounder
+        # Constituent rows by (constituent set id, element quantity set ids)
+        self._constituent_rows_cache: Dict[Tuple[int, Tuple[int, ...]], Optional[Tuple[Tuple[str, float, float], ...]]] = {}
+
+        self.object_type_of = element_memo(model, "object_type", get_object_type)
+        # Property and quantity sets are looked up through the model's property index
+        self.property_index = property_index_for(model)
+        property_index = self.property_index
+        self.common_properties_of = element_memo(
+            model, "common_properties",
+            lambda element, ifc_class: get_common_properties(element, property_index, ifc_class)
+        )
+        self.volume_of = element_memo(
+            model, "volume", functools.partial(get_volume_from_properties, index=self.property_index)
+        )
+
+        # Only set up material lookups when materials are part of the response
+        if not options.exclude_materials:
+            self.material_service = material_service_for(model)
+            self.materials_of = element_memo(model, "materials", self.material_service.get_element_materials)
+
+    def build(self, element: Any, ifc_class: str) -> Dict[str, Any]:
+        options = self.options
+        rounder = self.rounder
+        unit_factor = self.unit_factor
+
+        element_data: Dict[str, Any] = {
+            "id": element.GlobalId,
+            "ifc_class": ifc_class,
+            "object_type": self.object_type_of(element)
+        }
+        # Each quantity is extracted once and shared by the quantities and material blocks
+        volume = self.volume_of(element) if not (options.exclude_quantities and options.exclude_materials) else None
+        dimensions = None
+
+        if not options.exclude_properties:
+            # The class is already known, so the Pset_<Class>Common lookup skips is_a()
+            element_data["properties"] = self.common_properties_of(element, ifc_class)
+
+        if not options.exclude_quantities:
+            quantities: Dict[str, Any] = {}
+            if volume:
+                volume_data = quantities["volume"] = {}
+                rounder.set(volume_data, "net", volume["net"] if "net" in volume else None, 5)
+                rounder.set(volume_data, "gross", volume["gross"] if "gross" in volume else None, 5)
+
+            area = get_area_from_properties(element, self.property_index)
+            if area:
+                quantities["area"] = {key: value * unit_factor for key, value in area.items() if value is not None}
+
+            dimensions = get_dimensions_from_properties(element, self.property_index)
+            if dimensions:
+                dimensions_data = quantities["dimensions"] = {}
+                for key in ("length", "width", "height"):
+                    rounder.set(dimensions_data, key, dimensions[key])
+
+            if quantities:
+                element_data["quantities"] = quantities
+
+        if not options.exclude_materials:
+            # Looked up once and shared by the names, constituent and layer lookups
+            relating_materials = self.material_service.get_relating_materials(element)
+            materials = self.materials_of(element, relating_materials)
+            if materials:
+                element_data["materials"] = materials
+                self._add_material_volumes(element, element_data, volume, dimensions, relating_materials)
+
+        return element_data
+
+    def _constituent_rows(self, element: Any, constituent_set: Any) -> Optional[Tuple[Tuple[str, float, float], ...]]:
+        """(material key, fraction, width) per constituent of an element's constituent set.
+
+        Memoized per constituent set and the element's IfcElementQuantity sets,
+        which the widths come from; elements of a set without width quantities
+        all share one entry, so only the volumes are computed per element.
+        None when the fractions do not sum to approximately 1.
+        """
+        element_quantities = tuple(
+            definition for definition in self.property_index.property_definitions(element)
+            if definition.is_a() == 'IfcElementQuantity'
+        )
+        key = (constituent_set.id(), tuple(quantity.id() for quantity in element_quantities))
+        try:
+            return self._constituent_rows_cache[key]
+        except KeyError:
+            pass
+
+        constituent_fractions, constituent_widths = constituent_fractions_from_quantities(
+            constituent_set, element_quantities, self.unit_scale_mm
+        )
+        rows = None
+        # Only use constituent volumes if fractions sum to approximately 1
+        total_fraction = float(sum(constituent_fractions.values()))
+        if constituent_fractions and abs(total_fraction - 1.0) <= 0.001:
+            rows = []
+            name_counts: Dict[str, int] = {}
+            for constituent, fraction in constituent_fractions.items():
+                material_name = constituent.Material.Name if constituent.Material else "Unknown"
+                # Suffix repeated names with their occurrence count
+                count = name_counts.get(material_name, 0)
+                name_counts[material_name] = count + 1
+                material_key = material_name if count == 0 else f"{material_name} ({count})"
+                rows.append((material_key, fraction, constituent_widths[constituent] / 1000.0 * self.unit_factor))  # Convert mm to m
+            rows = tuple(rows)
+
+        self._constituent_rows_cache[key] = rows
+        return rows
+
+    def _add_material_volumes(
+        self,
+        element: Any,
+        element_data: Dict[str, Any],
+        volume: Optional[Dict[str, Any]],
+        dimensions: Optional[Dict[str, Any]],
+        relating_materials: List[Tuple[Any, str]]
+    ) -> None:
+        options = self.options
+        rounder = self.rounder
+        unit_factor = self.unit_factor
+
+        element_volume = volume
+        if isinstance(element_volume, dict):
+            element_volume = element_volume.get('net', element_volume.get('value', 0.0))
+
+        # The element's material associations are resolved once by the material
+        # service, together with their class names, and shared by every lookup
+        constituent_set = None
+        for relating_material, material_class in relating_materials:
+            if material_class == 'IfcMaterialConstituentSet':
+                constituent_set = relating_material
+                break
+
+        if not options.exclude_constituent_volumes and element_volume and constituent_set is not None:
+            constituent_rows = self._constituent_rows(element, constituent_set)
+            if constituent_rows is not None:
+                material_volumes_data = element_data["material_volumes"] = {}
+                element_volume = float(element_volume)
+                for material_key, fraction, width in constituent_rows:
+                    volume_data = material_volumes_data[material_key] = {}
+                    rounder.set(volume_data, "fraction", fraction, 5)
+                    rounder.set(volume_data, "volume", element_volume * float(fraction) * unit_factor, 5)
+                    if not options.exclude_width:
+                        volume_data["width"] = width
+
+        # Fall back to standard material volumes if no constituent volumes were added
+        if "material_volumes" not in element_data:
+            material_volumes = self.material_service.get_material_volumes(element, volume, dimensions, relating_materials)
+            if material_volumes:
+                total_fraction = sum(info["fraction"] for info in material_volumes.values())
+                if abs(total_fraction - 1.0) <= 0.001:
+                    element_data["material_volumes"] = {}
+                    for mat, info in material_volumes.items():
+                        volume_data: Dict[str, Any] = {}
+                        rounder.set(volume_data, "fraction", info["fraction"], 5)  # 5 digits for fraction
+                        rounder.set(volume_data, "volume", info["volume"] * unit_factor, 5)  # 5 digits for volume
+
+                        # Add width if requested
+                        if not options.exclude_width and "width" in info:
+                            volume_data["width"] = info["width"]  # Width is already in meters
+
+                        element_data["material_volumes"][mat] = volume_data
+
+# Seconds a worker keeps the upload it parsed after its last chunk: long
+# enough for the other chunks of a page and for paging through the file, but
+# idle workers do not each keep a copy of the model
+WORKER_MODEL_IDLE_SECONDS = 30.0
+
+_release_timer: Optional[threading.Timer] = None
+
+def init_extract_worker() -> None:
+    # Each worker only ever extracts from the upload it was last given
+    ifc_file_cache.maxsize = 1
+
+def _release_worker_model_later() -> None:
+    """Drop the worker's parsed upload once it has been idle for WORKER_MODEL_IDLE_SECONDS."""
+    global _release_timer
+    _release_timer = threading.Timer(WORKER_MODEL_IDLE_SECONDS, ifc_file_cache.clear)
+    _release_timer.daemon = True
+    _release_timer.start()
+
+def extract_chunk(
+    temp_path: str,
+    file_hash: str,
+    element_refs: List[Tuple[int, str]],
+    options: ExtractOptions
+) -> List[Dict[str, Any]]:
+    """Extract a chunk of (element id, class) pairs in a worker process.
+
+    ifcopenshell entities cannot be pickled, so the worker reopens the upload
+    through its own parse cache and looks the elements up by id. The parse is
+    kept for the worker's next chunk and dropped once the worker goes idle.
+    """
+    if _release_timer is not None:
+        _release_timer.cancel()
+    try:
+        model = ifc_file_cache.open(file_hash, temp_path)
+        by_id = model["ifc"].by_id
+        rounder = BatchRounder()
+        extractor = ElementExtractor(model, options, rounder)
+        elements = [extractor.build(by_id(element_id), ifc_class) for element_id, ifc_class in element_refs]
+        rounder.flush()
+        return elements
+    finally:
+        _release_worker_model_later()
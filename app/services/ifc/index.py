@@ -0,0 +1,47 @@
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+from collections import defaultdict
+
+class PropertyIndex:
+    """Property definitions of a model indexed by the id of the element they define.
+
+    Built in one pass over the IfcRelDefinesByProperties relations (including
+    IFC2X3's IfcRelOverridesProperties), so looking up an element's property
+    and quantity sets is a dict lookup instead of a walk over IsDefinedBy.
+    Material associations are indexed the same way by MaterialService.
+
+    The index is kept on the model's cache entry, so what it memoizes about
+    the model's property sets is released together with the model.
+    """
+
+    def __init__(self, ifc_file):
+        definitions: Dict[int, List[Any]] = defaultdict(list)
+        for rel in ifc_file.by_type("IfcRelDefinesByProperties"):
+            definition = rel.RelatingPropertyDefinition
+            if definition is None:
+                continue
+            # IFC4 allows a set of property definitions on one relation
+            related_definitions = definition if isinstance(definition, (list, tuple)) else (definition,)
+            for related_object in rel.RelatedObjects:
+                definitions[related_object.id()].extend(related_definitions)
+        self._definitions = dict(definitions)
+        self._set_values: Dict[Tuple[int, Callable, Tuple], Any] = {}
+
+    def __len__(self) -> int:
+        """Number of elements with property definitions."""
+        return len(self._definitions)
+
+    def property_definitions(self, element) -> Sequence[Any]:
+        """Get the property definitions (property sets, element quantities) of an element."""
+        return self._definitions.get(element.id(), ())
+
+    def set_values(self, definition, read: Callable, *args) -> Any:
+        """Get read(definition, *args), reading each property definition only once per args.
+
+        Exporters often share one property or quantity set between many
+        elements, so a shared set is only decoded for the first of them.
+        """
+        key = (definition.id(), read, args)
+        values = self._set_values.get(key)
+        if values is None:
+            values = self._set_values[key] = read(definition, *args)
+        return values
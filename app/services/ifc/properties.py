@@ -1,14 +1,12 @@
-from typing import Dict, Optional, List
+from typing import Any, Dict, Optional, List, Tuple
 import ifcopenshell
 from functools import lru_cache
 from datetime import datetime
-import gc
 
 def clear_property_caches():
     """Clear all LRU caches to free memory"""
     get_element_property.cache_clear()
     get_common_properties.cache_clear()
-    gc.collect()
 
 @lru_cache(maxsize=128)
 def get_element_property(element, property_name: str) -> Optional[str]:
@@ -94,9 +92,68 @@ def get_containment_structure(element) -> Dict:
     # Remove None values for cleaner output
     return {k: v for k, v in structure.items() if v is not None}
 
+# Property mapping with type conversion
+_COMMON_PROPERTY_MAPPING = {
+    "LoadBearing": ("loadBearing", bool),
+    "IsExternal": ("isExternal", bool),
+    "Description": ("description", str),
+    "FireRating": ("fireRating", str),
+    "Reference": ("reference", str),
+    "Status": ("status", str),
+    "ThermalTransmittance": ("thermalTransmittance", float),
+    "AcousticRating": ("acousticRating", str),
+    "Combustible": ("combustible", bool),
+    "SurfaceSpreadOfFlame": ("surfaceSpreadOfFlame", str),
+    "ExtendToStructure": ("extendToStructure", bool),
+    "Compartmentation": ("compartmentation", bool),
+    "Phase": ("phase", str),
+    "Manufacturer": ("manufacturer", str),
+    "ModelReference": ("model", str),
+    "SerialNumber": ("serialNumber", str),
+    "InstallationDate": ("installationDate", str),
+    "ConstructionMethod": ("constructionMethod", str)
+}
+
+def _property_set_values(pset, pset_name: str) -> Tuple[bool, str, Tuple[Tuple[str, Any], ...]]:
+    """Read an IfcPropertySet for get_common_properties as (is common set, name, (key, value) pairs).
+
+    Common sets (pset_name or Pset_ElementCommon) give converted values under
+    their response keys, other sets their non-empty values by property name.
+    """
+    name = pset.Name
+    values = []
+    if name == pset_name or name == "Pset_ElementCommon":
+        for prop in pset.HasProperties:
+            if prop.Name in _COMMON_PROPERTY_MAPPING:
+                key, type_conv = _COMMON_PROPERTY_MAPPING[prop.Name]
+                if hasattr(prop, "NominalValue"):
+                    try:
+                        value = getattr(prop.NominalValue, "wrappedValue", None)
+                        if value is not None:
+                            values.append((key, type_conv(value)))
+                    except (ValueError, TypeError):
+                        continue
+        return True, name, tuple(values)
+
+    for prop in pset.HasProperties:
+        if hasattr(prop, "NominalValue"):
+            try:
+                value = getattr(prop.NominalValue, "wrappedValue", None)
+                if value is not None:
+                    values.append((prop.Name, value))
+            except (ValueError, TypeError):
+                continue
+    return False, name, tuple(values)
+
 @lru_cache(maxsize=128)
-def get_common_properties(element) -> Dict:
-    """Get common properties for an element including description, fire rating, etc."""
+def get_common_properties(element, index=None, element_class: Optional[str] = None) -> Dict:
+    """Get common properties for an element including description, fire rating, etc.
+
+    With a PropertyIndex the element's property sets are looked up in it
+    instead of walking IsDefinedBy, and each set shared by many elements is
+    only read once; callers that already know the element's class can pass
+    it as element_class.
+    """
     properties = {
         "loadBearing": None,
         "isExternal": None,
@@ -120,59 +177,25 @@ def get_common_properties(element) -> Dict:
         "containment": get_containment_structure(element)
     }
     
-    element_class = element.is_a()[3:]
-    pset_name = f"Pset_{element_class}Common"
+    pset_name = f"Pset_{(element_class or element.is_a())[3:]}Common"
     
-    # Property mapping with type conversion
-    property_mapping = {
-        "LoadBearing": ("loadBearing", bool),
-        "IsExternal": ("isExternal", bool),
-        "Description": ("description", str),
-        "FireRating": ("fireRating", str),
-        "Reference": ("reference", str),
-        "Status": ("status", str),
-        "ThermalTransmittance": ("thermalTransmittance", float),
-        "AcousticRating": ("acousticRating", str),
-        "Combustible": ("combustible", bool),
-        "SurfaceSpreadOfFlame": ("surfaceSpreadOfFlame", str),
-        "ExtendToStructure": ("extendToStructure", bool),
-        "Compartmentation": ("compartmentation", bool),
-        "Phase": ("phase", str),
-        "Manufacturer": ("manufacturer", str),
-        "ModelReference": ("model", str),
-        "SerialNumber": ("serialNumber", str),
-        "InstallationDate": ("installationDate", str),
-        "ConstructionMethod": ("constructionMethod", str)
-    }
-    
-    for rel in element.IsDefinedBy:
-        if rel.is_a('IfcRelDefinesByProperties'):
-            pset = rel.RelatingPropertyDefinition
-            if pset.is_a('IfcPropertySet'):
+    if index is not None:
+        definitions = index.property_definitions(element)
+    else:
+        definitions = [rel.RelatingPropertyDefinition for rel in element.IsDefinedBy if rel.is_a('IfcRelDefinesByProperties')]
+
+    for pset in definitions:
+        if pset.is_a('IfcPropertySet'):
+            if index is not None:
+                is_common, name, values = index.set_values(pset, _property_set_values, pset_name)
+            else:
+                is_common, name, values = _property_set_values(pset, pset_name)
+            if is_common:
                 # Process common property sets
-                if pset.Name == pset_name or pset.Name == "Pset_ElementCommon":
-                    for prop in pset.HasProperties:
-                        if prop.Name in property_mapping:
-                            key, type_conv = property_mapping[prop.Name]
-                            if hasattr(prop, "NominalValue"):
-                                try:
-                                    value = getattr(prop.NominalValue, "wrappedValue", None)
-                                    if value is not None:
-                                        properties[key] = type_conv(value)
-                                except (ValueError, TypeError):
-                                    continue
-                else:
-                    # Store other properties in customProperties
-                    for prop in pset.HasProperties:
-                        if hasattr(prop, "NominalValue"):
-                            try:
-                                value = getattr(prop.NominalValue, "wrappedValue", None)
-                                if value is not None:
-                                    if pset.Name not in properties["customProperties"]:
-                                        properties["customProperties"][pset.Name] = {}
-                                    properties["customProperties"][pset.Name][prop.Name] = value
-                            except (ValueError, TypeError):
-                                continue
+                properties.update(values)
+            elif values:
+                # Store other properties in customProperties
+                properties["customProperties"].setdefault(name, {}).update(values)
     
     # Remove empty custom properties
     if not properties["customProperties"]:
@@ -217,7 +240,7 @@ def get_model_metadata(ifc_file) -> Dict:
             "name": project.Name,
             "description": project.Description,
             "phase": project.Phase,
-            "units": {unit.Name for unit in ifc_file.by_type("IfcSIUnit")} if ifc_file.by_type("IfcSIUnit") else set()
+            "units": sorted({unit.Name for unit in ifc_file.by_type("IfcSIUnit")})
         }
         
         # Get owner history information if available
@@ -1,6 +1,25 @@
-from typing import Dict
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 from functools import lru_cache
+import logging
+import multiprocessing
+import ifcopenshell.geom
+import ifcopenshell.util.shape
 from .properties import get_element_property, clear_property_caches
+from .index import PropertyIndex
+
+logger = logging.getLogger(__name__)
+
+# Classes are compared by exact name: is_a() without an argument skips the
+# schema lookup is_a('Name') does on every call. None of the quantity classes
+# has subtypes; IfcRelDefinesByProperties has IfcRelOverridesProperties in IFC2X3.
+PROPERTY_DEFINITION_RELS = frozenset({"IfcRelDefinesByProperties", "IfcRelOverridesProperties"})
+
+# Value attribute of each quantity class the lookups below read
+_QUANTITY_VALUE_ATTRIBUTES = {
+    "IfcQuantityVolume": "VolumeValue",
+    "IfcQuantityArea": "AreaValue",
+    "IfcQuantityLength": "LengthValue",
+}
 
 def clear_quantity_caches():
     """Clear all quantity-related caches"""
@@ -9,60 +28,73 @@ def clear_quantity_caches():
     get_dimensions_from_basequantities.cache_clear()
     clear_property_caches()
 
+def _quantity_set_values(quantity_set) -> Tuple[Tuple[str, str, float], ...]:
+    """Decode an IfcElementQuantity into (quantity class, name, value) rows."""
+    rows = []
+    for quantity in quantity_set.Quantities:
+        quantity_class = quantity.is_a()
+        value_attribute = _QUANTITY_VALUE_ATTRIBUTES.get(quantity_class)
+        if value_attribute is None:
+            continue
+        try:
+            rows.append((quantity_class, quantity.Name, float(getattr(quantity, value_attribute))))
+        except (ValueError, TypeError, AttributeError):
+            continue
+    return tuple(rows)
+
+def _element_quantities(element, index: Optional[PropertyIndex] = None) -> Iterator[Tuple[str, str, float]]:
+    """Yield the (quantity class, name, value) rows of an element's IfcElementQuantity sets.
+
+    With a PropertyIndex the sets are looked up instead of walking IsDefinedBy,
+    and each set shared by many elements is only decoded once.
+    """
+    if index is not None:
+        definitions = index.property_definitions(element)
+    else:
+        definitions = (
+            rel_def.RelatingPropertyDefinition
+            for rel_def in element.IsDefinedBy
+            if rel_def.is_a() in PROPERTY_DEFINITION_RELS
+        )
+    for prop_set in definitions:
+        if prop_set.is_a() == "IfcElementQuantity":
+            if index is not None:
+                yield from index.set_values(prop_set, _quantity_set_values)
+            else:
+                yield from _quantity_set_values(prop_set)
+
 @lru_cache(maxsize=128)
-def get_volume_from_basequantities(element) -> Dict:
+def get_volume_from_basequantities(element, index: Optional[PropertyIndex] = None) -> Dict:
     """Get volume quantities from base quantities."""
     net_volume = None
     gross_volume = None
     
-    for rel_def in element.IsDefinedBy:
-        if rel_def.is_a("IfcRelDefinesByProperties"):
-            prop_set = rel_def.RelatingPropertyDefinition
-            if prop_set.is_a("IfcElementQuantity"):
-                for quantity in prop_set.Quantities:
-                    if quantity.is_a("IfcQuantityVolume"):
-                        try:
-                            if quantity.Name == "NetVolume":
-                                net_volume = float(quantity.VolumeValue)
-                            elif quantity.Name == "GrossVolume":
-                                gross_volume = float(quantity.VolumeValue)
-                        except (ValueError, AttributeError):
-                            continue
-                    elif quantity.is_a("IfcQuantityLength"):
-                        try:
-                            if quantity.Name == "NetVolume":
-                                net_volume = float(quantity.LengthValue)
-                            elif quantity.Name == "GrossVolume":
-                                gross_volume = float(quantity.LengthValue)
-                        except (ValueError, AttributeError):
-                            continue
+    for quantity_class, name, value in _element_quantities(element, index):
+        if quantity_class == "IfcQuantityVolume" or quantity_class == "IfcQuantityLength":
+            if name == "NetVolume":
+                net_volume = value
+            elif name == "GrossVolume":
+                gross_volume = value
     
     return {"net": net_volume, "gross": gross_volume}
 
 @lru_cache(maxsize=128)
-def get_area_from_basequantities(element) -> Dict:
+def get_area_from_basequantities(element, index: Optional[PropertyIndex] = None) -> Dict:
     """Get area quantities from base quantities."""
     net_area = None
     gross_area = None
     
-    for rel_def in element.IsDefinedBy:
-        if rel_def.is_a("IfcRelDefinesByProperties"):
-            prop_set = rel_def.RelatingPropertyDefinition
-            if prop_set.is_a("IfcElementQuantity"):
-                for quantity in prop_set.Quantities:
-                    if quantity.is_a("IfcQuantityArea"):
-                        try:
-                            if quantity.Name in ["NetArea", "NetSideArea"]:
-                                net_area = float(quantity.AreaValue)
-                            elif quantity.Name in ["GrossArea", "GrossSideArea"]:
-                                gross_area = float(quantity.AreaValue)
-                        except (ValueError, AttributeError):
-                            continue
+    for quantity_class, name, value in _element_quantities(element, index):
+        if quantity_class == "IfcQuantityArea":
+            if name in ["NetArea", "NetSideArea"]:
+                net_area = value
+            elif name in ["GrossArea", "GrossSideArea"]:
+                gross_area = value
     
     return {"net": net_area, "gross": gross_area}
 
 @lru_cache(maxsize=128)
-def get_dimensions_from_basequantities(element) -> Dict:
+def get_dimensions_from_basequantities(element, index: Optional[PropertyIndex] = None) -> Dict:
     """Get dimensional quantities from base quantities."""
     dimensions = {
         "length": None,
@@ -70,27 +102,20 @@ def get_dimensions_from_basequantities(element) -> Dict:
         "height": None
     }
     
-    for rel_def in element.IsDefinedBy:
-        if rel_def.is_a("IfcRelDefinesByProperties"):
-            prop_set = rel_def.RelatingPropertyDefinition
-            if prop_set.is_a("IfcElementQuantity"):
-                for quantity in prop_set.Quantities:
-                    if quantity.is_a("IfcQuantityLength"):
-                        try:
-                            if quantity.Name == "Length":
-                                dimensions["length"] = float(quantity.LengthValue)
-                            elif quantity.Name in ["Width", "Thickness"]:
-                                dimensions["width"] = float(quantity.LengthValue)
-                            elif quantity.Name == "Height":
-                                dimensions["height"] = float(quantity.LengthValue)
-                        except (ValueError, AttributeError):
-                            continue
+    for quantity_class, name, value in _element_quantities(element, index):
+        if quantity_class == "IfcQuantityLength":
+            if name == "Length":
+                dimensions["length"] = value
+            elif name in ["Width", "Thickness"]:
+                dimensions["width"] = value
+            elif name == "Height":
+                dimensions["height"] = value
     
     return dimensions
 
-def get_volume_from_properties(element) -> Dict:
+def get_volume_from_properties(element, index: Optional[PropertyIndex] = None) -> Dict:
     """Get volumes from properties or base quantities."""
-    volumes = get_volume_from_basequantities(element)
+    volumes = get_volume_from_basequantities(element, index)
     if volumes["net"] is not None or volumes["gross"] is not None:
         return volumes
 
@@ -106,9 +131,9 @@ def get_volume_from_properties(element) -> Dict:
 
     return {"net": net_volume, "gross": gross_volume}
 
-def get_area_from_properties(element) -> Dict:
+def get_area_from_properties(element, index: Optional[PropertyIndex] = None) -> Dict:
     """Get areas from properties or base quantities."""
-    areas = get_area_from_basequantities(element)
+    areas = get_area_from_basequantities(element, index)
     if areas["net"] is not None or areas["gross"] is not None:
         return areas
 
@@ -124,9 +149,9 @@ def get_area_from_properties(element) -> Dict:
 
     return {"net": net_area, "gross": gross_area}
 
-def get_dimensions_from_properties(element) -> Dict:
+def get_dimensions_from_properties(element, index: Optional[PropertyIndex] = None) -> Dict:
     """Get dimensions from properties or base quantities."""
-    dimensions = get_dimensions_from_basequantities(element)
+    dimensions = get_dimensions_from_basequantities(element, index)
     if any(dimensions.values()):
         return dimensions
 
@@ -141,4 +166,30 @@ def get_dimensions_from_properties(element) -> Dict:
     except (ValueError, AttributeError):
         pass
 
-    return dimensions 
\ No newline at end of file
+    return dimensions
+
+def get_volumes_from_geometry(ifc_file, elements: Iterable) -> Dict[int, float]:
+    """Compute the volumes of elements from their body geometry, keyed by element id.
+
+    Meant as a fallback for elements without volume quantities or properties:
+    the geometry iterator tessellates them on one thread per core in a single
+    pass instead of calling create_shape per element. Volumes are in cubic metres.
+    """
+    elements = list(elements)
+    volumes: Dict[int, float] = {}
+    if not elements:
+        return volumes
+
+    settings = ifcopenshell.geom.settings()
+    iterator = ifcopenshell.geom.iterator(settings, ifc_file, multiprocessing.cpu_count(), include=elements)
+    if not iterator.initialize():
+        return volumes
+    while True:
+        shape = iterator.get()
+        try:
+            volumes[shape.id] = float(ifcopenshell.util.shape.get_volume(shape.geometry))
+        except Exception as e:
+            logger.warning(f"Could not compute the volume of element {shape.id}: {str(e)}")
+        if not iterator.next():
+            break
+    return volumes
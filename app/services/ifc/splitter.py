@@ -2,20 +2,32 @@ import os
 import logging
 import ifcopenshell
 from pathlib import Path
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Tuple
 import tempfile
-from shutil import copyfile
+import shutil
 import traceback
 
 logger = logging.getLogger(__name__)
 
+def split_file_by_storey(file_path: str) -> Tuple[List[Dict[str, str]], str]:
+    """Open an IFC file and split it by storey, returning (result_files, output_dir).
+
+    Takes and returns only paths so it can run in a worker process.
+    """
+    ifc_file = ifcopenshell.open(file_path)
+    return StoreySpiltterService(ifc_file).split_by_storey(src_path=file_path)
+
 class StoreySpiltterService:
     def __init__(self, ifc_file: ifcopenshell.file):
         self.file = ifc_file
 
-    def split_by_storey(self, output_dir: Union[str, None] = None) -> List[Dict[str, str]]:
-        """Split an IFC model into multiple models based on building storey."""
-        src_path = None
+    def split_by_storey(self, output_dir: Union[str, None] = None, src_path: Union[str, None] = None) -> List[Dict[str, str]]:
+        """Split an IFC model into multiple models based on building storey.
+
+        src_path is the IFC file the model was opened from. Passing it saves
+        writing the whole model back out to get a copy to read each storey from.
+        """
+        owns_src = src_path is None
         try:
             if output_dir is None:
                 output_dir = tempfile.mkdtemp()
@@ -23,11 +35,12 @@ class StoreySpiltterService:
                 output_dir = Path(output_dir)
                 output_dir.mkdir(parents=True, exist_ok=True)
 
-            # Create temporary file for the source
-            with tempfile.NamedTemporaryFile(suffix=".ifc", delete=False) as temp_file:
-                src_path = temp_file.name
-                logger.info(f"Writing source file to {src_path}")
-                self.file.write(src_path)
+            if owns_src:
+                # Create temporary file for the source
+                with tempfile.NamedTemporaryFile(suffix=".ifc", delete=False) as temp_file:
+                    src_path = temp_file.name
+                    logger.info(f"Writing source file to {src_path}")
+                    self.file.write(src_path)
 
             result_files = []
             storeys = self.file.by_type("IfcBuildingStorey")
@@ -43,9 +56,11 @@ class StoreySpiltterService:
                     dest_path = os.path.join(output_dir, filename)
                     logger.info(f"Processing storey {i}: {storey.Name} -> {dest_path}")
                     
-                    # Create the split file
-                    copyfile(src_path, dest_path)
-                    old_ifc = ifcopenshell.open(dest_path)
+                    # Each storey gets a fresh parse of the source, since elements of
+                    # other storeys are modified below; it needs its inverses, so it
+                    # cannot use a parse that skips them. The split file itself is
+                    # written to dest_path at the end.
+                    old_ifc = ifcopenshell.open(src_path)
                     new_ifc = ifcopenshell.file(schema=self.file.schema)
 
                     # Process elements
@@ -111,8 +126,11 @@ class StoreySpiltterService:
             raise
 
         finally:
-            if src_path and os.path.exists(src_path):
-                os.unlink(src_path)
+            if owns_src and src_path:
+                try:
+                    os.unlink(src_path)
+                except FileNotFoundError:
+                    pass
 
     def _is_in_storey(self, element: ifcopenshell.entity_instance, storey: ifcopenshell.entity_instance) -> bool:
         """Check if an element is contained in a specific storey."""
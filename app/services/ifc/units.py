@@ -55,42 +55,51 @@ def convert_unit_value(value: Union[float, Dict[str, float]],
     Returns:
         The converted value(s) in meters
     """
+    if value is None:
+        return None
+
+    # Resolve the factor once, also for every value of a dict
+    factor = get_unit_factor(source_unit)
     if isinstance(value, dict):
         return {
-            k: convert_unit_value(v, source_unit, target_unit)
+            k: v * factor
             for k, v in value.items()
             if v is not None
         }
-    
-    if value is None:
-        return None
         
-    # Get base conversion factor
+    return value * factor
+
+# SI unit prefixes
+PREFIX_FACTORS = {
+    "EXA": 1e18,
+    "PETA": 1e15,
+    "TERA": 1e12,
+    "GIGA": 1e9,
+    "MEGA": 1e6,
+    "KILO": 1e3,
+    "HECTO": 1e2,
+    "DECA": 1e1,
+    "DECI": 1e-1,
+    "CENTI": 1e-2,
+    "MILLI": 1e-3,
+    "MICRO": 1e-6,
+    "NANO": 1e-9,
+    "PICO": 1e-12,
+    "FEMTO": 1e-15,
+    "ATTO": 1e-18
+}
+
+def get_unit_factor(source_unit: Dict[str, Any]) -> float:
+    """Get the factor convert_unit_value multiplies values of source_unit by.
+
+    Resolve it once and multiply directly when converting many values with the same unit.
+    """
     factor = 1.0
     if source_unit.get("prefix"):
-        # Handle SI unit prefixes
-        prefix_factors = {
-            "EXA": 1e18,
-            "PETA": 1e15,
-            "TERA": 1e12,
-            "GIGA": 1e9,
-            "MEGA": 1e6,
-            "KILO": 1e3,
-            "HECTO": 1e2,
-            "DECA": 1e1,
-            "DECI": 1e-1,
-            "CENTI": 1e-2,
-            "MILLI": 1e-3,
-            "MICRO": 1e-6,
-            "NANO": 1e-9,
-            "PICO": 1e-12,
-            "FEMTO": 1e-15,
-            "ATTO": 1e-18
-        }
-        factor *= prefix_factors.get(source_unit["prefix"], 1.0)
-    
+        factor *= PREFIX_FACTORS.get(source_unit["prefix"], 1.0)
+
     # Apply any conversion factor for non-SI units
     if "conversion_factor" in source_unit:
         factor *= source_unit["conversion_factor"]
-    
-    return value * factor
\ No newline at end of file
+
+    return factor
@@ -1,133 +1,214 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import ifcopenshell
 import ifcopenshell.util.element
 import logging
-from app.services.ifc.quantities import get_volume_from_properties
+from collections import defaultdict
+from app.services.ifc.quantities import get_volume_from_properties, get_dimensions_from_properties
 
 logger = logging.getLogger(__name__)
 
+# Material classes are compared by exact name (material.is_a() == ...): none of
+# IfcRelAssociatesMaterial, IfcMaterial, IfcMaterialLayerSetUsage or
+# IfcMaterialConstituentSet has subtypes, and is_a() without an argument skips
+# the schema lookup that is_a('Name') performs on every call.
 class MaterialService:
     def __init__(self, ifc_file: ifcopenshell.file):
         self.ifc_file = ifc_file
+        self._material_names_cache: Dict[int, List[str]] = {}
+        self._material_profile_cache: Dict[int, Tuple[Tuple[str, float, Optional[float]], ...]] = {}
+        self._material_index: Optional[Dict[int, List[Tuple[object, str]]]] = None
 
-    def get_layer_volumes_and_materials(self, element, total_volume: float) -> List[Dict]:
+    def get_layer_volumes_and_materials(
+        self,
+        element,
+        total_volume: float,
+        relating_materials: Optional[List[Tuple[object, str]]] = None
+    ) -> List[Dict]:
         """Get material layers and their volumes for an element."""
         material_layers = []
+        if relating_materials is None:
+            relating_materials = self.get_relating_materials(element)
         
-        if element.HasAssociations:
-            for association in element.HasAssociations:
-                if association.is_a('IfcRelAssociatesMaterial'):
-                    material = association.RelatingMaterial
-                    
-                    if material.is_a('IfcMaterialLayerSetUsage'):
-                        material_layers.extend(
-                            self._process_layer_set(material.ForLayerSet, total_volume)
-                        )
-                    elif material.is_a('IfcMaterialConstituentSet'):
-                        material_layers.extend(
-                            self._process_constituent_set(material, total_volume)
-                        )
-                    elif material.is_a('IfcMaterial'):
-                        material_layers.append({
-                            "name": material.Name,
-                            "volume": total_volume,
-                            "fraction": 1.0
-                        })
+        for material, material_class in relating_materials:
+            profile = self._get_material_profile(material, material_class)
+            if material_class == 'IfcMaterialLayerSetUsage':
+                for name, fraction, width in profile:
+                    material_layers.append({
+                        "name": name,
+                        "volume": _round_value(total_volume * fraction, 5) if total_volume else 0,
+                        "fraction": _round_fraction(fraction),
+                        "width": width
+                    })
+            elif material_class == 'IfcMaterialConstituentSet':
+                for name, fraction, _ in profile:
+                    material_layers.append({
+                        "name": name,
+                        "volume": total_volume * fraction if total_volume else 0,
+                        "fraction": fraction
+                    })
+            elif material_class == 'IfcMaterial':
+                material_layers.append({
+                    "name": material.Name,
+                    "volume": total_volume,
+                    "fraction": 1.0
+                })
 
         return material_layers
 
-    def _process_layer_set(self, layer_set, total_volume: float) -> List[Dict]:
+    def _get_material_profile(self, material, material_class: str) -> Tuple[Tuple[str, float, Optional[float]], ...]:
+        """Get (name, volume fraction, rounded width) per layer or constituent of a relating material.
+
+        These do not depend on the element's size, so they are computed once per
+        layer set or constituent set (each wall has its own layer set usage, but
+        all walls of a type share the layer set) and only scaled by each
+        element's own volume.
+        """
+        is_usage = material_class == 'IfcMaterialLayerSetUsage'
+        material_set = material.ForLayerSet if is_usage else material
+        set_id = material_set.id()
+        profile = self._material_profile_cache.get(set_id)
+        if profile is None:
+            if is_usage:
+                profile = self._process_layer_set(material_set)
+            elif material_class == 'IfcMaterialConstituentSet':
+                profile = self._process_constituent_set(material_set)
+            else:
+                profile = ()
+            self._material_profile_cache[set_id] = profile
+        return profile
+
+    def _process_layer_set(self, layer_set) -> Tuple[Tuple[str, float, Optional[float]], ...]:
         """Process IfcMaterialLayerSet."""
-        layers = []
         total_thickness = sum(layer.LayerThickness for layer in layer_set.MaterialLayers)
         
-        for layer in layer_set.MaterialLayers:
-            fraction = layer.LayerThickness / total_thickness if total_thickness else 0
-            layer_volume = total_volume * fraction if total_volume else 0
-            
-            layers.append({
-                "name": layer.Material.Name if layer.Material else "Unnamed Material",
-                "volume": _round_value(layer_volume, 5),
-                "fraction": _round_fraction(fraction),
-                "width": _round_value(layer.LayerThickness)
-            })
-        
-        return layers
+        return tuple(
+            (
+                layer.Material.Name if layer.Material else "Unnamed Material",
+                layer.LayerThickness / total_thickness if total_thickness else 0,
+                _round_value(layer.LayerThickness)
+            )
+            for layer in layer_set.MaterialLayers
+        )
 
-    def _process_constituent_set(self, constituent_set, total_volume: float) -> List[Dict]:
+    def _process_constituent_set(self, constituent_set) -> Tuple[Tuple[str, float, Optional[float]], ...]:
         """Process IfcMaterialConstituentSet."""
-        constituents = []
         total_constituents = len(constituent_set.MaterialConstituents)
         
         if total_constituents == 0:
-            return constituents
+            return ()
 
         # Equal distribution if no specific fractions are defined
         fraction = 1.0 / total_constituents
         
-        for constituent in constituent_set.MaterialConstituents:
-            constituents.append({
-                "name": constituent.Material.Name if constituent.Material else "Unnamed Material",
-                "volume": total_volume * fraction if total_volume else 0,
-                "fraction": fraction
-            })
-        
-        return constituents
+        return tuple(
+            (constituent.Material.Name if constituent.Material else "Unnamed Material", fraction, None)
+            for constituent in constituent_set.MaterialConstituents
+        )
 
-    def get_element_materials(self, element) -> List[str]:
-        """Get list of material names for an element."""
+    def get_element_materials(self, element, relating_materials: Optional[List[Tuple[object, str]]] = None) -> List[str]:
+        """Get list of material names for an element.
+
+        Callers that already looked up the element's relating materials can
+        pass them in, as with get_material_volumes.
+        """
         materials = []
+        if relating_materials is None:
+            relating_materials = self.get_relating_materials(element)
         
-        if element.HasAssociations:
-            for association in element.HasAssociations:
-                if association.is_a('IfcRelAssociatesMaterial'):
-                    material = association.RelatingMaterial
-                    
-                    if material.is_a('IfcMaterialLayerSetUsage'):
-                        for layer in material.ForLayerSet.MaterialLayers:
-                            if layer.Material:
-                                materials.append(layer.Material.Name)
-                    
-                    elif material.is_a('IfcMaterialConstituentSet'):
-                        for constituent in material.MaterialConstituents:
-                            if constituent.Material:
-                                materials.append(constituent.Material.Name)
-                    
-                    elif material.is_a('IfcMaterial'):
-                        materials.append(material.Name)
+        for material, material_class in relating_materials:
+            materials.extend(self._get_material_names(material, material_class))
 
         return materials
 
-    def get_material_volumes(self, element):
-        volumes = get_volume_from_properties(element)
+    def has_materials(self) -> bool:
+        """Whether any element of the model has a material association."""
+        if self._material_index is None:
+            self._material_index = self._build_material_index()
+        return bool(self._material_index)
+
+    def get_relating_materials(self, element) -> List[Tuple[object, str]]:
+        """Get (material, class name) for each material associated with an element."""
+        if self._material_index is None:
+            self._material_index = self._build_material_index()
+        return self._material_index.get(element.id(), [])
+
+    def _build_material_index(self) -> Dict[int, List[Tuple[object, str]]]:
+        """Index material associations by related object id.
+
+        One pass over the IfcRelAssociatesMaterial relations replaces walking
+        HasAssociations element by element.
+        """
+        material_index = defaultdict(list)
+        for association in self.ifc_file.by_type('IfcRelAssociatesMaterial'):
+            material = association.RelatingMaterial
+            if material is None:
+                continue
+            entry = (material, material.is_a())
+            for related_object in association.RelatedObjects:
+                material_index[related_object.id()].append(entry)
+        return dict(material_index)
+
+    def _get_material_names(self, material, material_class: str) -> List[str]:
+        """Get material names of a relating material, cached by its id since many elements share one set."""
+        material_id = material.id()
+        names = self._material_names_cache.get(material_id)
+        if names is not None:
+            return names
+
+        names = []
+        if material_class == 'IfcMaterialLayerSetUsage':
+            for layer in material.ForLayerSet.MaterialLayers:
+                if layer.Material:
+                    names.append(layer.Material.Name)
+        
+        elif material_class == 'IfcMaterialConstituentSet':
+            for constituent in material.MaterialConstituents:
+                if constituent.Material:
+                    names.append(constituent.Material.Name)
+        
+        elif material_class == 'IfcMaterial':
+            names.append(material.Name)
+
+        self._material_names_cache[material_id] = names
+        return names
+
+    def get_material_volumes(
+        self,
+        element,
+        volumes: Optional[Dict] = None,
+        dimensions: Optional[Dict] = None,
+        relating_materials: Optional[List[Tuple[object, str]]] = None
+    ):
+        """Get volume, fraction and width per material of an element.
+
+        Callers that already extracted the element's volume, dimensions or
+        relating materials can pass them in to avoid looking them up again.
+        """
+        if volumes is None:
+            volumes = get_volume_from_properties(element)
         total_volume = volumes.get("net") or volumes.get("gross") or 0.0
         
-        material_layers = self.get_layer_volumes_and_materials(element, total_volume)
+        material_layers = self.get_layer_volumes_and_materials(element, total_volume, relating_materials)
         
         # Create material volumes with unique keys for each layer
         material_volumes = {}
         
         # If we have only one material and no layer information, try to get width from element dimensions
         if len(material_layers) == 1 and "width" not in material_layers[0]:
-            from app.services.ifc.quantities import get_dimensions_from_properties
-            dimensions = get_dimensions_from_properties(element)
+            if dimensions is None:
+                dimensions = get_dimensions_from_properties(element)
             if dimensions and "width" in dimensions:
                 material_layers[0]["width"] = dimensions["width"]
         
-        # Create a mapping of layer index to unique key
-        layer_to_key = {}
+        # Occurrences of each material name so far, for suffixing repeated names
+        name_counts: Dict[str, int] = {}
         
-        for i, layer in enumerate(material_layers):
+        for layer in material_layers:
             material_name = layer["name"]
             # Create unique key for each layer
-            key = material_name
-            counter = 1
-            while key in material_volumes:
-                key = f"{material_name} ({counter})"
-                counter += 1
-            
-            # Store mapping of layer index to key
-            layer_to_key[i] = key
+            count = name_counts.get(material_name, 0)
+            name_counts[material_name] = count + 1
+            key = material_name if count == 0 else f"{material_name} ({count})"
             
             # Copy all data from layer with rounded values
             material_volumes[key] = {
@@ -1,5 +1,7 @@
 import warnings
 import pytest
+import ifcopenshell
+import ifcopenshell.api
 
 @pytest.fixture(autouse=True)
 def ignore_pydantic_warnings():
@@ -7,4 +9,58 @@ def ignore_pydantic_warnings():
         "ignore",
         message="Support for class-based.*",
         category=DeprecationWarning
-    ) 
\ No newline at end of file
+    )
+
+def build_sample_model(walls_per_storey: int = 3) -> ifcopenshell.file:
+    """Build a small IFC4 model: two storeys of layered walls with common properties and base quantities."""
+    run = ifcopenshell.api.run
+    model = ifcopenshell.file(schema="IFC4")
+    project = run("root.create_entity", model, ifc_class="IfcProject", name="Sample Project")
+    run("unit.assign_unit", model, length={"is_metric": True, "raw": "METERS"})
+    site = run("root.create_entity", model, ifc_class="IfcSite", name="Site")
+    building = run("root.create_entity", model, ifc_class="IfcBuilding", name="Building")
+    run("aggregate.assign_object", model, products=[site], relating_object=project)
+    run("aggregate.assign_object", model, products=[building], relating_object=site)
+
+    # One layer set, property set and quantity set shared by every wall, as exporters do
+    concrete = run("material.add_material", model, name="Concrete")
+    insulation = run("material.add_material", model, name="Insulation")
+    layer_set = run("material.add_material_set", model, name="Exterior Wall", set_type="IfcMaterialLayerSet")
+    for material, thickness in ((concrete, 0.2), (insulation, 0.1)):
+        layer = run("material.add_layer", model, layer_set=layer_set, material=material)
+        layer.LayerThickness = thickness
+
+    walls = []
+    for level, storey_name in enumerate(("Ground Floor", "First Floor")):
+        storey = run("root.create_entity", model, ifc_class="IfcBuildingStorey", name=storey_name)
+        storey.Elevation = level * 3.0
+        run("aggregate.assign_object", model, products=[storey], relating_object=building)
+        storey_walls = [
+            run("root.create_entity", model, ifc_class="IfcWall", name=f"{storey_name} Wall {i}")
+            for i in range(walls_per_storey)
+        ]
+        run("spatial.assign_container", model, products=storey_walls, relating_structure=storey)
+        walls.extend(storey_walls)
+
+    run("material.assign_material", model, products=walls, type="IfcMaterialLayerSetUsage", material=layer_set)
+    common = run("pset.add_pset", model, product=walls[0], name="Pset_WallCommon")
+    run("pset.edit_pset", model, pset=common, properties={"LoadBearing": True, "IsExternal": True, "FireRating": "REI60"})
+    quantities = run("pset.add_qto", model, product=walls[0], name="Qto_WallBaseQuantities")
+    run("pset.edit_qto", model, qto=quantities, properties={
+        "Length": 5.0, "Width": 0.3, "Height": 3.0, "NetSideArea": 15.0, "NetVolume": 4.5, "GrossVolume": 4.75
+    })
+    for definition in (common, quantities):
+        definition.DefinesOccurrence[0].RelatedObjects = walls
+    return model
+
+@pytest.fixture(scope="session")
+def sample_ifc(tmp_path_factory) -> str:
+    """Path of a small generated IFC file (see build_sample_model)."""
+    path = tmp_path_factory.mktemp("ifc") / "sample.ifc"
+    build_sample_model().write(str(path))
+    return str(path)
+
+@pytest.fixture
+def sample_model() -> ifcopenshell.file:
+    """A fresh in-memory model from build_sample_model."""
+    return build_sample_model()
@@ -0,0 +1,79 @@
+import os
+import zipfile
+import pytest
+from app.services.ifc import archive
+
+COMPRESSIONS = {
+    "deflate": zipfile.ZIP_DEFLATED,
+    "stored": zipfile.ZIP_STORED,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+@pytest.fixture
+def storey_files(tmp_path):
+    """(path, arcname) files like a split produces, including an empty one and a non-ASCII name"""
+    contents = {
+        "0-Ground Floor.ifc": b"ISO-10303-21;\n" + b"#1=IFCWALL('2O2Fr$t4X7Zf8NOew3FLOH',$,$,$,$,$,$,$,$);\n" * 2000,
+        "1-Empty.ifc": b"",
+        "2-Obergeschoß Süd.ifc": os.urandom(64 * 1024),
+    }
+    files = []
+    for arcname, data in contents.items():
+        path = tmp_path / f"storey{len(files)}.ifc"
+        path.write_bytes(data)
+        files.append((str(path), arcname))
+    return files, contents
+
+def assert_archive(zip_path, contents, compression):
+    """The archive holds exactly contents, each member compressed with compression and passing its CRC check"""
+    with zipfile.ZipFile(zip_path) as zipf:
+        assert zipf.testzip() is None
+        assert zipf.namelist() == list(contents)
+        for info in zipf.infolist():
+            assert info.compress_type == compression
+            assert zipf.read(info) == contents[info.filename]
+            if not info.filename.isascii():
+                assert info.flag_bits & 0x800
+
+def leftover_deflate_files(files):
+    return [path for path, _ in files if os.path.exists(path + ".deflate")]
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_write_zip_round_trip(tmp_path, storey_files, compression):
+    files, contents = storey_files
+    zip_path = tmp_path / "storeys.zip"
+    archive.write_zip(str(zip_path), files, COMPRESSIONS[compression])
+    assert_archive(zip_path, contents, COMPRESSIONS[compression])
+    assert not leftover_deflate_files(files)
+
+@pytest.mark.parametrize("compression", ["deflate", "stored"])
+def test_iter_zip_files_round_trip(tmp_path, storey_files, compression):
+    files, contents = storey_files
+    zip_path = tmp_path / "storeys.zip"
+    zip_path.write_bytes(b"".join(archive.iter_zip_files(files, compression=COMPRESSIONS[compression], max_workers=2)))
+    assert_archive(zip_path, contents, COMPRESSIONS[compression])
+    assert not leftover_deflate_files(files)
+    # Stored members are the storey files themselves and stay in place
+    assert all(os.path.exists(path) for path, _ in files)
+
+def test_iter_zip_files_stopped_early_removes_deflate_files(storey_files):
+    files, _ = storey_files
+    chunks = archive.iter_zip_files(files, max_workers=2)
+    assert next(chunks).startswith(b"PK\x03\x04")
+    chunks.close()
+    assert not leftover_deflate_files(files)
+
+def test_zip_files_falls_back_to_zip64_writer(tmp_path, storey_files, monkeypatch):
+    files, contents = storey_files
+    # Shrink the plain zip limit below the size of the first storey
+    monkeypatch.setattr(archive, "_ZIP32_LIMIT", 1024)
+    assert not archive.fits_zip32(files)
+    zip_path = tmp_path / "storeys.zip"
+    archive.zip_files(str(zip_path), files)
+    assert_archive(zip_path, contents, zipfile.ZIP_DEFLATED)
+    assert not leftover_deflate_files(files)
+
+def test_fits_zip32(storey_files):
+    files, _ = storey_files
+    assert archive.fits_zip32(files)
+    assert archive.fits_zip32([])
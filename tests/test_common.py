@@ -0,0 +1,94 @@
+import os
+import orjson
+import pytest
+from dotenv import load_dotenv
+
+load_dotenv()
+# The app settings are read when the routes are imported
+if not os.getenv("API_KEY"):
+    pytest.skip(allow_module_level=True, reason="API_KEY must be set in .env file")
+
+from app.api.routes.ifc.common import iter_json_batches, page_window
+from app.services.ifc.extraction import BatchRounder
+
+def _json(chunks) -> dict:
+    return orjson.loads(b"".join(chunks))
+
+@pytest.mark.parametrize("head, batches, expected", [
+    ({"metadata": {"page": 1}}, [[1, 2], [3]], {"metadata": {"page": 1}, "elements": [1, 2, 3]}),
+    ({}, [[{"id": 1}], [{"id": 2}]], {"elements": [{"id": 1}, {"id": 2}]}),
+    ({"a": 1}, [[], [1], [], [], [2, 3], []], {"a": 1, "elements": [1, 2, 3]}),
+    ({"a": 1}, [[], []], {"a": 1, "elements": []}),
+    ({}, [], {"elements": []}),
+])
+def test_iter_json_batches(head, batches, expected):
+    assert _json(iter_json_batches(head, "elements", batches)) == expected
+
+def test_iter_json_batches_streams_lazily():
+    """Each non-empty batch is encoded as it is produced"""
+    produced = []
+    def batches():
+        for batch in ([1], [], [2]):
+            produced.append(batch)
+            yield batch
+
+    chunks = iter_json_batches({"a": 1}, "elements", batches())
+    assert next(chunks) == b'{"a":1,"elements":['
+    assert produced == []
+    assert next(chunks) == b'1'
+    assert next(chunks) == b',2'
+    assert produced == [[1], [], [2]]
+    assert next(chunks) == b']}'
+
+SEQUENCES = [[0, 1, 2], [], [3, 4], [5, 6, 7, 8]]
+
+@pytest.mark.parametrize("start, stop", [
+    (0, 9), (0, 2), (1, 4), (2, 6), (3, 5), (4, 9), (8, 9), (0, 100), (9, 20), (50, 60), (3, 3),
+])
+def test_page_window(start, stop):
+    flat = [item for sequence in SEQUENCES for item in sequence]
+    assert list(page_window(SEQUENCES, start, stop)) == flat[start:stop]
+
+def test_page_window_stops_at_the_page():
+    """Sequences after the page are never asked for"""
+    seen = []
+    def sequences():
+        for sequence in SEQUENCES:
+            seen.append(sequence)
+            yield sequence
+
+    assert list(page_window(sequences(), 1, 3)) == [1, 2]
+    assert seen == SEQUENCES[:1]
+
+def test_batch_rounder_mixed_digits():
+    rounder = BatchRounder()
+    first, second = {}, {}
+    rounder.set(first, "volume", 1.23456)
+    rounder.set(first, "area", 1.23456, digits=5)
+    rounder.set(second, "width", 0.123456789, digits=2)
+    rounder.set(second, "ratio", 2 / 3, digits=0)
+    # Unrounded until flushed
+    assert first["volume"] == 1.23456
+
+    rounder.flush()
+    assert first == {"volume": 1.235, "area": 1.23456}
+    assert second == {"width": 0.12, "ratio": 1.0}
+
+def test_batch_rounder_passes_non_floats_through():
+    rounder = BatchRounder()
+    target = {}
+    for key, value in (("count", 3), ("name", "Wall"), ("missing", None), ("flag", True), ("length", 2.00049)):
+        rounder.set(target, key, value)
+    rounder.flush()
+    assert target == {"count": 3, "name": "Wall", "missing": None, "flag": True, "length": 2.0}
+    assert type(target["count"]) is int
+
+def test_batch_rounder_flush_clears():
+    rounder = BatchRounder()
+    target = {}
+    rounder.set(target, "volume", 1.23456)
+    rounder.flush()
+    # A later flush does not write old values back over changed ones
+    target["volume"] = 9.87654
+    rounder.flush()
+    assert target["volume"] == 9.87654
@@ -1,7 +1,19 @@
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
+from app.api.routes.ifc import common, extract_elements, process, split_by_storey
+from app.services.ifc import extraction
+from app.services.ifc.extraction import ElementExtractor
+import ifcopenshell
+import asyncio
+import gc
+import threading
+import time
+import httpx
+import gzip
+import io
 import os
+import zipfile
 import json
 from datetime import datetime
 from dotenv import load_dotenv
@@ -129,4 +141,507 @@ def test_invalid_api_key():
         headers={"X-API-Key": "invalid-key"}
     )
     assert response.status_code == 401
-    assert response.json()["detail"] == "Invalid or missing API Key"
\ No newline at end of file
+    assert response.json()["detail"] == "Invalid or missing API Key"
+
+def _asgi_scope(request: httpx.Request) -> dict:
+    """ASGI scope of an httpx request, for driving the app directly"""
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": request.method,
+        "scheme": "http",
+        "path": request.url.path,
+        "query_string": request.url.query,
+        "root_path": "",
+        "headers": [(key.lower(), value) for key, value in request.headers.raw],
+        "client": ("testclient", 50000),
+        "server": ("testserver", 80)
+    }
+
+async def _disconnect_after_first_chunk(request: httpx.Request) -> list:
+    """Send request to the app and disconnect once the first body chunk arrives; returns the sent messages"""
+    body = request.read()
+    first_chunk = asyncio.Event()
+    messages = []
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await first_chunk.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.body" and message.get("body"):
+            first_chunk.set()
+
+    await app(_asgi_scope(request), receive, send)
+    return messages
+
+def test_extract_building_elements_disconnect_removes_upload(sample_ifc, tmp_path, monkeypatch):
+    """A client that disconnects mid-stream leaves no upload behind and stops the extraction"""
+    monkeypatch.setattr(common, "UPLOAD_TMPDIR", str(tmp_path))
+
+    # Hold the extraction of the first chunk until the client has gone away
+    resume = threading.Event()
+    built = []
+    build = ElementExtractor.build
+    def held_build(self, element, ifc_class):
+        resume.wait(10)
+        built.append(element.id())
+        return build(self, element, ifc_class)
+    monkeypatch.setattr(ElementExtractor, "build", held_build)
+
+    closed = threading.Event()
+    def tracked_batches(*args):
+        try:
+            yield from common.iter_json_batches(*args)
+        finally:
+            closed.set()
+    monkeypatch.setattr(extract_elements, "iter_json_batches", tracked_batches)
+
+    with open(sample_ifc, "rb") as f:
+        request = httpx.Request(
+            "POST",
+            "http://testserver/api/ifc/extract-building-elements",
+            params={"page_size": 6},
+            files={"file": ("sample.ifc", f.read(), "application/x-step")},
+            headers=HEADERS
+        )
+    messages = asyncio.run(_disconnect_after_first_chunk(request))
+
+    assert messages[0]["status"] == 200
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".ifc")]
+
+    # The worker finishes the chunk it is on, then stops instead of extracting the rest
+    resume.set()
+    assert closed.wait(10)
+    assert len(built) == 1
+
+@pytest.fixture
+def split_jobs(monkeypatch):
+    """Split job state of its own for a test, with the split worker stopped afterwards"""
+    monkeypatch.setattr(split_by_storey, "_split_jobs", {})
+    yield split_by_storey
+    split_by_storey.shutdown_split_pool()
+
+async def _poll_split_job(client: httpx.AsyncClient, job_id: str, done=("complete", "failed")) -> dict:
+    """Poll a split job until its status is one of done"""
+    for _ in range(600):
+        response = await client.get(f"/api/ifc/split-by-storey/jobs/{job_id}", headers=HEADERS)
+        assert response.status_code == 200
+        status = response.json()
+        if status["status"] in done:
+            return status
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Split job {job_id} did not finish")
+
+def _async_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver")
+
+def test_split_job(sample_ifc, split_jobs):
+    """A split job is accepted with 202, can be polled, and its result is a zip of the storeys"""
+    async def scenario():
+        async with _async_client() as client:
+            with open(sample_ifc, "rb") as f:
+                response = await client.post(
+                    "/api/ifc/split-by-storey/jobs",
+                    files={"file": ("sample.ifc", f, "application/x-step")},
+                    headers=HEADERS
+                )
+            assert response.status_code == 202
+            job = response.json()
+            assert job["status"] == "queued"
+
+            status = await _poll_split_job(client, job["job_id"])
+            assert status == {"job_id": job["job_id"], "status": "complete"}
+            return await client.get(f"/api/ifc/split-by-storey/jobs/{job['job_id']}/result", headers=HEADERS)
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zipf:
+        assert zipf.testzip() is None
+        assert zipf.namelist() == ["0-Ground Floor.ifc", "1-First Floor.ifc"]
+
+def test_split_job_result_while_running_and_failed(sample_ifc, split_jobs, monkeypatch):
+    """The result of a running or failed split job is a 409"""
+    async def scenario():
+        release = asyncio.Event()
+        async def held_split(file_path):
+            await release.wait()
+            raise ValueError("No storeys found in the IFC file")
+        monkeypatch.setattr(split_jobs, "_split_file", held_split)
+
+        async with _async_client() as client:
+            with open(sample_ifc, "rb") as f:
+                job = (await client.post(
+                    "/api/ifc/split-by-storey/jobs",
+                    files={"file": ("sample.ifc", f, "application/x-step")},
+                    headers=HEADERS
+                )).json()
+            result_url = f"/api/ifc/split-by-storey/jobs/{job['job_id']}/result"
+
+            await _poll_split_job(client, job["job_id"], done=("processing",))
+            running = await client.get(result_url, headers=HEADERS)
+            assert running.status_code == 409
+            assert running.json()["detail"] == "Split job is processing"
+
+            release.set()
+            status = await _poll_split_job(client, job["job_id"])
+            assert status["status"] == "failed"
+            assert status["error"] == "No storeys found in the IFC file"
+            failed = await client.get(result_url, headers=HEADERS)
+            assert failed.status_code == 409
+            assert failed.json()["detail"] == "No storeys found in the IFC file"
+
+    asyncio.run(scenario())
+
+def test_split_job_unknown_id(split_jobs):
+    response = client.get("/api/ifc/split-by-storey/jobs/unknown", headers=HEADERS)
+    assert response.status_code == 404
+    response = client.get("/api/ifc/split-by-storey/jobs/unknown/result", headers=HEADERS)
+    assert response.status_code == 404
+
+def test_split_job_limit(sample_ifc, split_jobs, monkeypatch):
+    """New split jobs are turned away with 503 while MAX_ACTIVE_SPLIT_JOBS are running"""
+    monkeypatch.setattr(split_jobs, "MAX_ACTIVE_SPLIT_JOBS", 1)
+
+    async def scenario():
+        release = asyncio.Event()
+        async def held_split(file_path):
+            await release.wait()
+            return [], None
+        monkeypatch.setattr(split_jobs, "_split_file", held_split)
+
+        async with _async_client() as client:
+            statuses = []
+            for _ in range(2):
+                with open(sample_ifc, "rb") as f:
+                    response = await client.post(
+                        "/api/ifc/split-by-storey/jobs",
+                        files={"file": ("sample.ifc", f, "application/x-step")},
+                        headers=HEADERS
+                    )
+                statuses.append(response.status_code)
+            release.set()
+            await asyncio.gather(*split_jobs._split_job_tasks)
+            return statuses
+
+    assert asyncio.run(scenario()) == [202, 503]
+
+def test_split_job_upload_limit(sample_ifc, split_jobs, monkeypatch):
+    """Split job uploads over MAX_UPLOAD_SIZE are rejected with 413 and leave no temp file"""
+    monkeypatch.setattr(split_jobs.settings, "MAX_UPLOAD_SIZE", 1024)
+    with open(sample_ifc, "rb") as f:
+        response = client.post(
+            "/api/ifc/split-by-storey/jobs",
+            files={"file": ("sample.ifc", f, "application/x-step")},
+            headers=HEADERS
+        )
+    assert response.status_code == 413
+    assert split_jobs._split_jobs == {}
+
+def test_split_job_expires(sample_ifc, split_jobs, monkeypatch):
+    """Finished split jobs are dropped with their files SPLIT_JOB_TTL after they finished"""
+    monkeypatch.setattr(split_jobs, "SPLIT_JOB_TTL", 0.2)
+
+    async def scenario():
+        async with _async_client() as client:
+            with open(sample_ifc, "rb") as f:
+                job = (await client.post(
+                    "/api/ifc/split-by-storey/jobs",
+                    files={"file": ("sample.ifc", f, "application/x-step")},
+                    headers=HEADERS
+                )).json()
+            await _poll_split_job(client, job["job_id"])
+            output_dir = split_jobs._split_jobs[job["job_id"]].output_dir
+            assert os.path.isdir(output_dir)
+
+            for _ in range(100):
+                await asyncio.sleep(0.05)
+                if job["job_id"] not in split_jobs._split_jobs and not split_jobs._split_job_tasks:
+                    break
+            response = await client.get(f"/api/ifc/split-by-storey/jobs/{job['job_id']}", headers=HEADERS)
+            return response.status_code, output_dir
+
+    status_code, output_dir = asyncio.run(scenario())
+    assert status_code == 404
+    assert not os.path.exists(output_dir)
+
+def _process_lines(text: str) -> list:
+    return [json.loads(line) for line in text.splitlines()]
+
+def test_process_ifc_sample(sample_ifc):
+    """/process streams every product with its quantities and materials, then the count"""
+    with open(sample_ifc, "rb") as f:
+        response = client.post(
+            "/api/ifc/process",
+            files={"file": ("sample.ifc", f, "application/x-step")},
+            headers=HEADERS
+        )
+    assert response.status_code == 200
+    lines = _process_lines(response.text)
+    elements = [line["data"] for line in lines if line["status"] == "element"]
+    assert lines[-1] == {"status": "complete", "count": len(elements)}
+    assert lines[-2]["status"] == "processing" and lines[-2]["progress"] == 100.0
+    # Site, building, two storeys and six walls
+    assert len(elements) == 10
+
+    walls = [element for element in elements if element["ifc_entity"] == "IfcWall"]
+    assert len(walls) == 6
+    for wall in walls:
+        assert wall["volume"] == {"net": 4.5, "gross": 4.75}
+        assert wall["dimensions"] == {"length": 5.0, "width": 0.3, "height": 3.0}
+        assert wall["materials"] == ["Concrete", "Insulation"]
+        assert wall["material_volumes"]["Concrete"] == {"volume": 3.0, "fraction": 0.66667, "width": 0.2}
+        assert wall["properties"]["loadBearing"] is True
+        assert wall["properties"]["fireRating"] == "REI60"
+
+def _extract_elements(ifc_path: str, **params) -> dict:
+    with open(ifc_path, "rb") as f:
+        response = client.post(
+            "/api/ifc/extract-building-elements",
+            params=params,
+            files={"file": ("sample.ifc", f, "application/x-step")},
+            headers=HEADERS
+        )
+    assert response.status_code == 200
+    return response.json()
+
+def test_extract_building_elements_pool_matches_serial(sample_ifc, monkeypatch):
+    """Pages extracted by the worker processes are the same as pages extracted in-process"""
+    serial = _extract_elements(sample_ifc)
+    monkeypatch.setattr(extract_elements, "PARALLEL_MIN_ELEMENTS", 1)
+    monkeypatch.setattr(extract_elements, "EXTRACT_WORKERS", 2)
+    try:
+        pooled = _extract_elements(sample_ifc)
+        assert extract_elements._extract_pool is not None
+    finally:
+        extract_elements.shutdown_extract_pool()
+    assert len(pooled["elements"]) == 6
+    assert pooled == serial
+
+def test_extract_chunk_releases_model_when_idle(sample_ifc, monkeypatch):
+    """A worker drops its parsed upload once it has gone idle"""
+    monkeypatch.setattr(extraction, "WORKER_MODEL_IDLE_SECONDS", 0.1)
+    monkeypatch.setattr(extraction.ifc_file_cache, "maxsize", 1)
+    wall_refs = [(wall.id(), "IfcWall") for wall in ifcopenshell.open(sample_ifc).by_type("IfcWall")]
+
+    first = extraction.extract_chunk(sample_ifc, "worker-sample", wall_refs[:3], extraction.ExtractOptions())
+    # A chunk that follows within the idle time reuses the parse
+    time.sleep(0.05)
+    assert "worker-sample" in extraction.ifc_file_cache
+    second = extraction.extract_chunk(sample_ifc, "worker-sample", wall_refs[3:], extraction.ExtractOptions())
+    assert len(first) == len(second) == 3
+
+    time.sleep(0.3)
+    assert "worker-sample" not in extraction.ifc_file_cache
+
+def test_extract_building_elements_cache_key_paging(sample_ifc):
+    """The next page can be requested with only the cache_key of the first"""
+    first = _extract_elements(sample_ifc, page_size=4)
+    cache_key = first["metadata"]["cache_key"]
+    assert first["metadata"]["total_pages"] == 2
+    assert len(first["elements"]) == 4
+
+    response = client.post(
+        "/api/ifc/extract-building-elements",
+        params={"page_size": 4, "page": 2, "cache_key": cache_key},
+        headers=HEADERS
+    )
+    assert response.status_code == 200
+    second = response.json()
+    assert second["metadata"]["current_page"] == 2
+    assert second["metadata"]["cache_key"] == cache_key
+    assert len(second["elements"]) == 2
+    first_ids = {element["id"] for element in first["elements"]}
+    assert first_ids.isdisjoint(element["id"] for element in second["elements"])
+
+@pytest.mark.parametrize("endpoint", ["extract-building-elements", "elements-info"])
+def test_unknown_cache_key(endpoint):
+    response = client.post(f"/api/ifc/{endpoint}", params={"cache_key": "unknown"}, headers=HEADERS)
+    assert response.status_code == 404
+    assert response.json()["detail"] == common.UNKNOWN_CACHE_KEY
+
+@pytest.mark.parametrize("endpoint", ["extract-building-elements", "elements-info"])
+def test_cache_key_evicted_before_open(endpoint, monkeypatch):
+    """A cache_key evicted between the lookup and opening the model is a 404, not an error"""
+    monkeypatch.setattr(type(common.ifc_file_cache), "__contains__", lambda self, key: True)
+    response = client.post(f"/api/ifc/{endpoint}", params={"cache_key": "evicted"}, headers=HEADERS)
+    assert response.status_code == 404
+    assert response.json()["detail"] == common.UNKNOWN_CACHE_KEY
+
+def _elements_info(ifc_path: str, **params) -> list:
+    with open(ifc_path, "rb") as f:
+        response = client.post(
+            "/api/ifc/elements-info",
+            params={"enable_filter": True, "ifc_classes": "IfcProject", **params},
+            files={"file": ("sample.ifc", f, "application/x-step")},
+            headers=HEADERS
+        )
+    assert response.status_code == 200
+    return response.json()["elements"]
+
+def _is_stub(value) -> bool:
+    return isinstance(value, dict) and set(value) == {"id", "type"}
+
+def test_elements_info_max_depth(sample_ifc):
+    """References are expanded max_depth levels deep and returned as {id, type} stubs below that"""
+    shallow = _elements_info(sample_ifc, max_depth=0)[0]
+    assert shallow["ifc_class"] == shallow["type"] == "IfcProject"
+    assert shallow["Name"] == "Sample Project"
+    assert _is_stub(shallow["UnitsInContext"])
+    assert shallow["UnitsInContext"]["type"] == "IfcUnitAssignment"
+
+    # The default expands one level: the unit assignment, but not the units in it
+    default = _elements_info(sample_ifc)[0]
+    assert default == _elements_info(sample_ifc, max_depth=1)[0]
+    units = default["UnitsInContext"]
+    assert units["id"] == shallow["UnitsInContext"]["id"]
+    assert units["type"] == "IfcUnitAssignment"
+    assert units["Units"] and all(_is_stub(unit) for unit in units["Units"])
+
+    complete = _elements_info(sample_ifc, max_depth=-1)[0]
+    complete_units = complete["UnitsInContext"]["Units"]
+    assert [unit["type"] for unit in complete_units] == [unit["type"] for unit in units["Units"]]
+    assert not any(_is_stub(unit) for unit in complete_units)
+    assert complete["GlobalId"] == default["GlobalId"] == shallow["GlobalId"]
+
+def test_elements_info_max_depth_below_minus_one(sample_ifc):
+    with open(sample_ifc, "rb") as f:
+        response = client.post(
+            "/api/ifc/elements-info",
+            params={"max_depth": -2},
+            files={"file": ("sample.ifc", f, "application/x-step")},
+            headers=HEADERS
+        )
+    assert response.status_code == 422
+
+@pytest.mark.parametrize("accept_encoding, accepts", [
+    ("gzip", True),
+    ("gzip, deflate, br", True),
+    ("deflate, GZIP;q=0.5", True),
+    ("gzip; q=1.0", True),
+    ("*", True),
+    ("gzip;q=0", False),
+    ("gzip;q=0.0, deflate", False),
+    ("gzip;q=0, *", False),
+    ("*;q=0, gzip", True),
+    ("*;q=0", False),
+    ("gzip;q=abc", False),
+    ("identity", False),
+    ("deflate, br", False),
+    ("", False),
+])
+def test_accepts_gzip(accept_encoding, accepts):
+    assert process._accepts_gzip(accept_encoding) is accepts
+
+def _post_process(ifc_path: str, accept_encoding: str) -> tuple:
+    """POST /process and return the response headers and its body as sent, without decoding it"""
+    with open(ifc_path, "rb") as f:
+        with client.stream(
+            "POST",
+            "/api/ifc/process",
+            files={"file": ("sample.ifc", f, "application/x-step")},
+            headers={**HEADERS, "Accept-Encoding": accept_encoding}
+        ) as response:
+            assert response.status_code == 200
+            return response.headers, b"".join(response.iter_raw())
+
+def test_process_ifc_gzip(sample_ifc):
+    """A gzip stream decodes to the same NDJSON lines as the uncompressed one"""
+    plain_headers, plain = _post_process(sample_ifc, "identity")
+    assert "content-encoding" not in plain_headers
+
+    gzip_headers, compressed = _post_process(sample_ifc, "gzip")
+    assert gzip_headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in gzip_headers["vary"]
+    assert _process_lines(gzip.decompress(compressed).decode()) == _process_lines(plain.decode())
+
+class _RecordingCallbackClient:
+    """Stands in for the shared callback client and keeps the payloads posted to it"""
+    def __init__(self):
+        self.payloads = []
+
+    async def post(self, url, headers=None, content=None):
+        self.payloads.append(json.loads(content))
+
+def test_extract_building_elements_callback_progress(sample_ifc, monkeypatch):
+    """Callback progress counts through the page; total_elements is the model total in every payload"""
+    callback_client = _RecordingCallbackClient()
+    monkeypatch.setattr(extract_elements, "get_callback_client", lambda: callback_client)
+    with open(sample_ifc, "rb") as f:
+        response = client.post(
+            "/api/ifc/extract-building-elements",
+            params={"page_size": 4, "page": 2},
+            data={"callback_config": json.dumps({"url": "http://callback.test/hook", "token": "secret"})},
+            files={"file": ("sample.ifc", f, "application/x-step")},
+            headers=HEADERS
+        )
+    assert response.status_code == 200
+    assert "task_id" in response.json()
+
+    *updates, final = callback_client.payloads
+    assert updates
+    for update in updates:
+        assert update["status"] == "processing"
+        assert update["total_elements"] == 6
+        assert update["page_elements"] == 2
+    assert updates[-1]["processed_elements"] == 2
+    assert updates[-1]["progress"] == 100
+
+    assert final["status"] == "completed"
+    assert final["result"]["metadata"]["total_elements"] == 6
+    assert len(final["result"]["elements"]) == 2
+
+def test_process_ifc_disconnect_resumes_gc(sample_ifc, monkeypatch):
+    """The collector is only paused while a batch is built, and is on again after an abandoned stream"""
+    assert gc.isenabled()
+    # One batch per chunk, so the client can leave after the first of several
+    monkeypatch.setattr(process, "STREAM_BATCH_SIZE", 2)
+    monkeypatch.setattr(process, "STREAM_FLUSH_SIZE", 1)
+
+    rendered_with_gc = []
+    render_batch = process._render_batch
+    def tracked_render_batch(*args):
+        rendered_with_gc.append(gc.isenabled())
+        return render_batch(*args)
+    monkeypatch.setattr(process, "_render_batch", tracked_render_batch)
+
+    # Whether the collector is on while the stream is suspended at each yield
+    yielded_with_gc = []
+    closed = threading.Event()
+    iterate = process.iterate_in_thread
+    def tracked_iterate(chunks):
+        def tracked_chunks():
+            try:
+                for chunk in chunks:
+                    yielded_with_gc.append(gc.isenabled())
+                    yield chunk
+            finally:
+                closed.set()
+        return iterate(tracked_chunks())
+    monkeypatch.setattr(process, "iterate_in_thread", tracked_iterate)
+
+    with open(sample_ifc, "rb") as f:
+        request = httpx.Request(
+            "POST",
+            "http://testserver/api/ifc/process",
+            files={"file": ("sample.ifc", f.read(), "application/x-step")},
+            headers={**HEADERS, "Accept-Encoding": "identity"}
+        )
+    messages = asyncio.run(_disconnect_after_first_chunk(request))
+
+    assert messages[0]["status"] == 200
+    assert closed.wait(10)
+    assert rendered_with_gc and not any(rendered_with_gc)
+    assert yielded_with_gc and all(yielded_with_gc)
+    # Stopped part-way through the five batches
+    assert len(rendered_with_gc) < 5
+    assert gc.isenabled()
+    assert process._gc_pause_count == 0
@@ -0,0 +1,66 @@
+from app.services.ifc import properties, quantities
+from app.services.ifc.index import PropertyIndex
+
+WALL_QUANTITIES = [
+    ("IfcQuantityLength", "Length", 5.0),
+    ("IfcQuantityLength", "Width", 0.3),
+    ("IfcQuantityLength", "Height", 3.0),
+    ("IfcQuantityArea", "NetSideArea", 15.0),
+    ("IfcQuantityVolume", "NetVolume", 4.5),
+    ("IfcQuantityVolume", "GrossVolume", 4.75),
+]
+
+def counting(monkeypatch, module, name):
+    """Replace module.name with a wrapper that counts its calls"""
+    calls = []
+    read = getattr(module, name)
+    def counted(*args):
+        calls.append(args)
+        return read(*args)
+    monkeypatch.setattr(module, name, counted)
+    return calls
+
+def test_shared_quantity_set_decoded_once(sample_model, monkeypatch):
+    model = sample_model
+    index = PropertyIndex(model)
+    decoded = counting(monkeypatch, quantities, "_quantity_set_values")
+
+    for wall in model.by_type("IfcWall"):
+        assert sorted(quantities._element_quantities(wall, index)) == sorted(WALL_QUANTITIES)
+    assert len(decoded) == 1
+
+def test_quantity_sets_without_index_are_not_cached(sample_model, monkeypatch):
+    model = sample_model
+    decoded = counting(monkeypatch, quantities, "_quantity_set_values")
+
+    walls = model.by_type("IfcWall")
+    for wall in walls:
+        assert sorted(quantities._element_quantities(wall)) == sorted(WALL_QUANTITIES)
+    assert len(decoded) == len(walls)
+
+def test_decoded_sets_belong_to_the_index(sample_model, monkeypatch):
+    """Each model's index decodes its own sets, so they are dropped with the model's cache entry"""
+    decoded = counting(monkeypatch, quantities, "_quantity_set_values")
+    wall = sample_model.by_type("IfcWall")[0]
+    for _ in range(2):
+        index = PropertyIndex(sample_model)
+        list(quantities._element_quantities(wall, index))
+        list(quantities._element_quantities(wall, index))
+    assert len(decoded) == 2
+
+def test_shared_property_set_read_once(sample_model, monkeypatch):
+    index = PropertyIndex(sample_model)
+    read = counting(monkeypatch, properties, "_property_set_values")
+
+    walls = sample_model.by_type("IfcWall")
+    for wall in walls:
+        common = properties.get_common_properties(wall, index, "IfcWall")
+        assert common["loadBearing"] is True
+        assert common["isExternal"] is True
+        assert common["fireRating"] == "REI60"
+    assert len(read) == 1
+
+    # The set is read again for another pset_name, where it is not the common set
+    slab_properties = properties.get_common_properties(walls[0], index, "IfcSlab")
+    assert slab_properties["customProperties"]["Pset_WallCommon"]["FireRating"] == "REI60"
+    assert len(read) == 2